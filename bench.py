@@ -0,0 +1,325 @@
+"""
+Offline benchmark for the bot engines.
+
+Runs indexing, forwarding, duplicate scan + cleanup, caption editing and the MongoDB
+library sync end to end against a simulated Telegram and an in-process collection
+(no network, no real sessions, no database) and reports items/sec, wall time, API
+calls and peak memory per phase.
+
+    python bench.py --messages 20000 --sessions 5 --latency 0.02 --flood-rate 0.001
+    python bench.py --batched --json results.json   # compare runs / catch regressions
+"""
+import os, sys, time, json, random, asyncio, argparse, tempfile, tracemalloc, resource
+from types import SimpleNamespace as NS
+
+# ==============================================================================
+# ⚙️ ARGUMENTS
+# ==============================================================================
+
+parser = argparse.ArgumentParser(description="Offline benchmark with a simulated Telegram client")
+parser.add_argument("--messages", type=int, default=20000, help="Messages in the synthetic source channel")
+parser.add_argument("--sessions", type=int, default=5, help="Simulated sessions (1-5)")
+parser.add_argument("--latency", type=float, default=0.01, help="Seconds per simulated API call")
+parser.add_argument("--flood-rate", type=float, default=0.0, help="Probability that a call raises FloodWait")
+parser.add_argument("--flood-seconds", type=int, default=0, help="FloodWait value to inject")
+parser.add_argument("--dupes", type=int, default=3, help="Average copies of every title")
+parser.add_argument("--batched", action="store_true", help="Use batched (multi-id) forwarding")
+parser.add_argument("--fuzzy", action="store_true", help="Use fuzzy duplicate clustering")
+parser.add_argument("--window", type=int, help="Override every PIPELINE_CONFIG window (1 = one request in flight)")
+parser.add_argument("--sync-strategy", choices=["probe", "scan"], help="Force the DB sync validation strategy")
+parser.add_argument("--real-rates", action="store_true", help="Keep RATE_CONFIG instead of unthrottled buckets")
+parser.add_argument("--no-tracemalloc", action="store_true", help="Skip per-phase heap tracking (faster)")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--json", help="Write results to this file")
+args = parser.parse_args()
+
+# bot.py reads its config from the environment and keeps its state files in the cwd
+WORKDIR = tempfile.mkdtemp(prefix="bot-bench-")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("ADMIN_ID", "1")
+for i in range(1, args.sessions + 1): os.environ[f"SESSION{i}"] = f"bench-session-{i}"
+OUTPUT = os.path.abspath(args.json) if args.json else None
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORKDIR)
+
+import bot
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+
+# ==============================================================================
+# 📡 SIMULATED TELEGRAM
+# ==============================================================================
+
+SOURCE_ID, TARGET_ID = -1001, -1002
+QUALITIES = ["480p", "720p", "1080p", "2160p", "720p HDCAM", "1080p WEB-DL x265", "1080p BluRay"]
+
+def media_message(msg_id, title, size, caption):
+    doc = NS(file_name=title, file_size=size, file_unique_id=f"u{msg_id}", mime_type="video/x-matroska")
+    return NS(id=msg_id, empty=False, video=None, document=doc, caption=caption)
+
+def empty_message(msg_id):
+    return NS(id=msg_id, empty=True, video=None, document=None, caption=None)
+
+class FakeTelegram:
+    """Channels shared by all simulated sessions, plus per-method call counters."""
+    def __init__(self, messages, dupes, rnd):
+        self.rnd = rnd
+        self.calls = {}
+        self.floods = 0
+        self.chats = {SOURCE_ID: {}, TARGET_ID: {}}
+        self.top = {SOURCE_ID: 0, TARGET_ID: 0}
+        titles = max(1, messages // dupes)
+        tag = bot.EDIT_CONFIG["remove"][0] if bot.EDIT_CONFIG["remove"] else ""
+        for _ in range(messages):
+            t = rnd.randrange(titles)
+            title = f"Movie {t} ({1980 + t % 40}) {rnd.choice(QUALITIES)}.mkv"
+            caption = f"{title} {tag}" if rnd.random() < 0.3 else title
+            self.post(SOURCE_ID, lambda i: media_message(i, title, rnd.randrange(200, 4000) * 2**20, caption))
+
+    def post(self, chat_id, factory):
+        self.top[chat_id] += 1
+        msg = factory(self.top[chat_id])
+        self.chats[chat_id][msg.id] = msg
+        return msg
+
+    def copy(self, from_chat, msg_id, to_chat):
+        src = self.chats[from_chat].get(msg_id)
+        if not src: return None
+        return self.post(to_chat, lambda i: NS(id=i, empty=False, video=None, document=src.document, caption=src.caption))
+
+class FakeClient:
+    """Stand-in for pyrogram.Client with configurable latency and FloodWait injection."""
+    def __init__(self, name, world):
+        self.name = name
+        self.world = world
+        self.is_connected = True
+
+    async def call(self, method, flood=True):
+        self.world.calls[method] = self.world.calls.get(method, 0) + 1
+        if args.latency: await asyncio.sleep(args.latency)
+        if flood and args.flood_rate and self.world.rnd.random() < args.flood_rate:
+            self.world.floods += 1
+            raise FloodWait(value=args.flood_seconds)
+
+    def rnd_id(self): return self.world.rnd.getrandbits(63)
+
+    async def resolve_peer(self, chat_id): return chat_id
+
+    async def get_chat(self, ref):
+        await self.call("get_chat", flood=False)
+        chat_id = TARGET_ID if "target" in str(ref) else SOURCE_ID
+        return NS(id=chat_id, title=str(ref))
+
+    async def get_chat_history(self, chat_id, limit=0, offset_id=0):
+        # Pyrogram sleeps through short FloodWaits inside iterators, so pages never raise here
+        n = 0
+        for msg_id in sorted(self.world.chats[chat_id], reverse=True):
+            if offset_id and msg_id >= offset_id: continue
+            if n % 100 == 0: await self.call("get_chat_history", flood=False)
+            yield self.world.chats[chat_id][msg_id]
+            n += 1
+            if limit and n >= limit: return
+
+    async def get_messages(self, chat_id, message_ids):
+        await self.call("get_messages")
+        chat = self.world.chats[chat_id]
+        return [chat.get(i) or empty_message(i) for i in message_ids]
+
+    async def copy_message(self, chat_id, from_chat_id, message_id):
+        await self.call("copy_message")
+        return self.world.copy(from_chat_id, message_id, chat_id)
+
+    async def forward_messages(self, chat_id, from_chat_id, message_ids):
+        await self.call("forward_messages")
+        return self.world.copy(from_chat_id, message_ids, chat_id)
+
+    async def invoke(self, query):
+        await self.call(type(query).__name__)
+        updates = []
+        for msg_id, random_id in zip(query.id, query.random_id):
+            msg = self.world.copy(query.from_peer, msg_id, query.to_peer)
+            if msg: updates.append(raw.types.UpdateMessageID(id=msg.id, random_id=random_id))
+        return NS(updates=updates)
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self.call("delete_messages")
+        for i in message_ids: self.world.chats[chat_id].pop(i, None)
+
+    async def edit_message_caption(self, chat_id, message_id, caption):
+        await self.call("edit_message_caption")
+        msg = self.world.chats[chat_id].get(message_id)
+        if msg: msg.caption = caption
+
+# ==============================================================================
+# 🍃 SIMULATED MONGODB
+# ==============================================================================
+
+OTHER_CHANNEL_ID = -1009 # Library entries of another channel: the sync must never touch them
+
+def matches(doc, query):
+    """The subset of Mongo filters the bot sends: equality, $exists and $in."""
+    for field, cond in query.items():
+        if isinstance(cond, dict):
+            if "$exists" in cond and (field in doc) != cond["$exists"]: return False
+            if "$in" in cond and doc.get(field) not in cond["$in"]: return False
+        elif doc.get(field) != cond: return False
+    return True
+
+class FakeCursor:
+    """Motor-style cursor: one simulated round trip per batch_size documents."""
+    def __init__(self, col, query, projection, batch_size):
+        self.col, self.query, self.projection, self.batch_size = col, query, projection, batch_size or 101
+
+    def project(self, doc):
+        if not self.projection: return dict(doc)
+        keep = {k for k, v in self.projection.items() if v}
+        return {k: v for k, v in doc.items() if k in keep or (k == "_id" and self.projection.get("_id", 1))}
+
+    async def __aiter__(self):
+        n = 0
+        for doc in list(self.col.docs.values()):
+            if not matches(doc, self.query): continue
+            if n % self.batch_size == 0: await self.col.world_call("mongo_find")
+            yield self.project(doc)
+            n += 1
+
+class FakeCollection:
+    """In-process stand-in for a Motor collection (find + delete_many), keyed by _id."""
+    def __init__(self, world):
+        self.world = world
+        self.docs = {}
+
+    async def world_call(self, method):
+        self.world.calls[method] = self.world.calls.get(method, 0) + 1
+        if args.latency: await asyncio.sleep(args.latency)
+
+    def insert(self, doc):
+        doc.setdefault("_id", len(self.docs) + 1)
+        self.docs[doc["_id"]] = doc
+
+    def count(self, channel_id):
+        return sum(1 for doc in self.docs.values() if doc.get("channel_id") == channel_id)
+
+    def find(self, query, projection=None, batch_size=None):
+        return FakeCursor(self, query, projection, batch_size)
+
+    async def delete_many(self, query):
+        await self.world_call("mongo_delete_many")
+        ids = [_id for _id, doc in self.docs.items() if matches(doc, query)]
+        for _id in ids: del self.docs[_id]
+        return NS(deleted_count=len(ids))
+
+class FakeDatabase:
+    """Replaces database.Database: mongo_collection() finds `movies` and takes the bulk path."""
+    def __init__(self, url): self.movies = MONGO
+
+    async def init_db(self): return True
+
+    async def close(self): pass
+
+class FakeCommand:
+    """Admin command message; status edits are counted, not sent."""
+    def __init__(self, *command):
+        self.command = list(command)
+        self.edits = 0
+
+    async def reply(self, text, **kwargs): return self
+
+    async def edit(self, text, **kwargs): self.edits += 1
+
+    async def reply_document(self, *a, **kwargs): return self
+
+# ==============================================================================
+# 🏁 PHASES
+# ==============================================================================
+
+RESULTS = []
+
+async def command(handler, client, cmd):
+    """Command handlers only submit a job; wait for it like the admin would."""
+    job = await handler(client, cmd)
+    if job: await bot.JOBS.wait(job)
+
+async def phase(name, coro, items):
+    """Runs one engine and records wall time, items/sec, API calls and peak memory."""
+    calls_before = sum(WORLD.calls.values())
+    floods_before = WORLD.floods
+    if not args.no_tracemalloc: tracemalloc.reset_peak()
+    start = time.perf_counter()
+    await coro
+    wall = time.perf_counter() - start
+    n = items()
+    result = {
+        "phase": name, "items": n, "wall_s": round(wall, 3),
+        "items_per_s": round(n / wall, 1) if wall else 0,
+        "api_calls": sum(WORLD.calls.values()) - calls_before,
+        "floodwaits": WORLD.floods - floods_before,
+        "peak_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 1) if not args.no_tracemalloc else None
+    }
+    RESULTS.append(result)
+    print(f"✅ {name:<16} {n:>8} items  {wall:>8.2f}s  {result['items_per_s']:>10}/s  "
+          f"{result['api_calls']:>7} calls  {result['floodwaits']:>4} flood  {result['peak_mb']} MB")
+
+async def main():
+    client = CLIENTS[0]
+    source, target = bot.DB_FILES["full_source"], bot.DB_FILES["full_target"]
+    await phase("index_source", bot.indexing_engine(client, FakeCommand(), "@source", source),
+                lambda: bot.INDEX_STORE.counts().get(source, 0))
+    await phase("index_target", bot.indexing_engine(client, FakeCommand(), "@target", target),
+                lambda: bot.INDEX_STORE.counts().get(target, 0))
+
+    before = len(WORLD.chats[TARGET_ID])
+    await phase("forward", bot.forwarding_engine(FakeCommand(), source, target, "@target", batched=args.batched),
+                lambda: len(WORLD.chats[TARGET_ID]) - before)
+
+    scan = FakeCommand("scan_library_dupes", "@source", *(["fuzzy"] if args.fuzzy else []))
+    await phase("scan_dupes", command(bot.scan_dupes_cmd, client, scan), lambda: len(WORLD.chats[SOURCE_ID]))
+    before = len(WORLD.chats[SOURCE_ID])
+    await phase("confirm_delete", command(bot.confirm_clean, client, FakeCommand("confirm_clean")),
+                lambda: before - len(WORLD.chats[SOURCE_ID]))
+
+    await phase("edit_scan", command(bot.edit_meta_cmd, client, FakeCommand("edit_metadata", "@source")), lambda: len(WORLD.chats[SOURCE_ID]))
+    plan = bot.PLANS.info(bot.PLANS.latest())
+    planned = plan["count"] if plan else 0
+    await phase("confirm_edit", command(bot.confirm_clean, client, FakeCommand("confirm_clean")), lambda: planned)
+
+    # Every source message got a library entry up front, so the deleted dupes are the orphans
+    sync = FakeCommand("sync_library_with_db", "@source", *([args.sync_strategy] if args.sync_strategy else []))
+    entries = MONGO.count(SOURCE_ID)
+    await phase("sync_scan", command(bot.sync_db_cmd, client, sync), lambda: entries)
+    plan = bot.PLANS.info(bot.PLANS.latest())
+    planned = plan["count"] if plan else 0
+    await phase("confirm_sync", command(bot.confirm_clean, client, FakeCommand("confirm_clean")),
+                lambda: entries - MONGO.count(SOURCE_ID))
+    orphans = entries - len(WORLD.chats[SOURCE_ID])
+    if planned != orphans or MONGO.count(SOURCE_ID) != len(WORLD.chats[SOURCE_ID]) or MONGO.count(OTHER_CHANNEL_ID) != entries:
+        print(f"❌ sync mismatch: planned {planned}, orphans {orphans}, left {MONGO.count(SOURCE_ID)}, other {MONGO.count(OTHER_CHANNEL_ID)}")
+
+if __name__ == "__main__":
+    rnd = random.Random(args.seed)
+    WORLD = FakeTelegram(args.messages, args.dupes, rnd)
+    CLIENTS = [FakeClient(f"bench_{i + 1}", WORLD) for i in range(args.sessions)]
+    MONGO = FakeCollection(WORLD)
+    for msg_id in WORLD.chats[SOURCE_ID]:
+        for channel_id in (SOURCE_ID, OTHER_CHANNEL_ID):
+            MONGO.insert({"message_id": msg_id, "channel_id": channel_id, "imdb_id": f"tt{msg_id:07d}", "title": f"Movie {msg_id}"})
+    bot.DB_AVAILABLE, bot.DATABASE_URL, bot.Database = True, "mongodb://bench", FakeDatabase
+    bot.ALL_CLIENTS[:] = CLIENTS
+    bot.app = CLIENTS[0]
+    if not args.real_rates:
+        for kind in ("copy", "edit", "delete", "read"): bot.RATE_CONFIG[kind].update(rate=1e6, burst=1e6, max=1e6)
+
+    if args.window:
+        for kind in bot.PIPELINE_CONFIG: bot.PIPELINE_CONFIG[kind] = args.window
+    print(f"🧪 {args.messages} messages | {args.sessions} sessions | latency {args.latency}s | "
+          f"flood {args.flood_rate} | batched {args.batched} | workdir {WORKDIR}")
+    if not args.no_tracemalloc: tracemalloc.start()
+    start = time.perf_counter()
+    asyncio.run(main())
+    total = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"⏱️ Total {total:.2f}s | max RSS {rss:.0f} MB | calls {WORLD.calls}")
+    if OUTPUT:
+        with open(OUTPUT, "w") as f:
+            json.dump({"args": vars(args), "total_s": round(total, 3), "max_rss_mb": round(rss), "phases": RESULTS, "calls": WORLD.calls}, f, indent=2)
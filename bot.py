@@ -1,11 +1,19 @@
-import os, re, json, asyncio, time, math
-from threading import Thread
-from flask import Flask
-from pyrogram import Client, filters, enums, compose, idle
+import os, re, io, sys, json, asyncio, time, math, gzip, sqlite3, threading, contextvars, cProfile, pstats, tracemalloc
+import mmap, struct, hashlib
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from collections import deque
+from itertools import groupby, islice
+from functools import lru_cache, wraps
+from types import SimpleNamespace
+from threading import Thread, Lock
+from flask import Flask, Response
+from pyrogram import Client, filters, enums, idle, raw
 from pyrogram.errors import (
     FloodWait, ChatAdminRequired, InviteHashExpired, InviteHashInvalid, 
     PeerIdInvalid, UserAlreadyParticipant, MessageIdInvalid, MessageAuthorRequired, 
-    RPCError, UsernameInvalid, ChannelPrivate
+    RPCError, UsernameInvalid, ChannelPrivate, MessageNotModified
 )
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
@@ -23,6 +31,7 @@ API_ID = int(os.getenv("API_ID"))
 API_HASH = os.getenv("API_HASH")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 DATABASE_URL = os.getenv("DATABASE_URL") # For MongoDB Sync
+INDEX_COMPRESS = os.getenv("INDEX_COMPRESS", "").lower() in ("1", "true", "yes") # gzip the JSONL indexes
 
 # EXTENSION: Multi-Session Support (5 Sessions)
 SESSION1 = os.getenv("SESSION1", os.getenv("SESSION_STRING"))
@@ -42,6 +51,10 @@ app_web = Flask(__name__)
 def home():
     return "✅ Ultra Bot V4 (5-Core) is Running! System Status: Nominal."
 
+@app_web.route('/metrics')
+def metrics():
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 def run_web_server():
     port = int(os.getenv("PORT", 8080))
     app_web.run(host="0.0.0.0", port=port)
@@ -55,11 +68,28 @@ def start_web_server():
         print("📱 Mobile/Termux Mode Detected: Web Server Disabled.")
 
 # --- ADVANCED CLIENT SETUP (5 SESSIONS) ---
-app = Client("advanced_bot_1", api_id=API_ID, api_hash=API_HASH, session_string=SESSION1, in_memory=True, ipv6=False)
-app2 = Client("advanced_bot_2", api_id=API_ID, api_hash=API_HASH, session_string=SESSION2 if SESSION2 else SESSION1, in_memory=True, ipv6=False)
-app3 = Client("advanced_bot_3", api_id=API_ID, api_hash=API_HASH, session_string=SESSION3 if SESSION3 else SESSION1, in_memory=True, ipv6=False)
-app4 = Client("advanced_bot_4", api_id=API_ID, api_hash=API_HASH, session_string=SESSION4 if SESSION4 else SESSION1, in_memory=True, ipv6=False)
-app5 = Client("advanced_bot_5", api_id=API_ID, api_hash=API_HASH, session_string=SESSION5 if SESSION5 else SESSION1, in_memory=True, ipv6=False)
+class MeteredClient(Client):
+    """Client whose every raw API call is counted and timed in METRICS, per session and method."""
+    async def invoke(self, query, *args, **kwargs):
+        method = type(query).__name__
+        start = time.perf_counter()
+        try: return await super().invoke(query, *args, **kwargs)
+        except FloodWait as e:
+            METRICS.inc("tg_floodwait_seconds_total", e.value, session=self.name, method=method)
+            METRICS.inc("tg_api_errors_total", session=self.name, method=method, error="FloodWait")
+            raise
+        except Exception as e:
+            METRICS.inc("tg_api_errors_total", session=self.name, method=method, error=type(e).__name__)
+            raise
+        finally:
+            METRICS.inc("tg_api_calls_total", session=self.name, method=method)
+            METRICS.observe("tg_api_latency_seconds", time.perf_counter() - start, session=self.name, method=method)
+
+app = MeteredClient("advanced_bot_1", api_id=API_ID, api_hash=API_HASH, session_string=SESSION1, in_memory=True, ipv6=False)
+app2 = MeteredClient("advanced_bot_2", api_id=API_ID, api_hash=API_HASH, session_string=SESSION2 if SESSION2 else SESSION1, in_memory=True, ipv6=False)
+app3 = MeteredClient("advanced_bot_3", api_id=API_ID, api_hash=API_HASH, session_string=SESSION3 if SESSION3 else SESSION1, in_memory=True, ipv6=False)
+app4 = MeteredClient("advanced_bot_4", api_id=API_ID, api_hash=API_HASH, session_string=SESSION4 if SESSION4 else SESSION1, in_memory=True, ipv6=False)
+app5 = MeteredClient("advanced_bot_5", api_id=API_ID, api_hash=API_HASH, session_string=SESSION5 if SESSION5 else SESSION1, in_memory=True, ipv6=False)
 
 ALL_CLIENTS = [app]
 if SESSION2: ALL_CLIENTS.append(app2)
@@ -67,19 +97,21 @@ if SESSION3: ALL_CLIENTS.append(app3)
 if SESSION4: ALL_CLIENTS.append(app4)
 if SESSION5: ALL_CLIENTS.append(app5)
 
-# --- GLOBAL SETTINGS (EXISTING) ---
-GLOBAL_TASK_RUNNING = False
-PER_MSG_DELAY = 0.2
-BATCH_SIZE = 250
-BREAK_TIME = 35
-
 # --- DB FILES (EXISTING) ---
+INDEX_EXT = ".jsonl.gz" if INDEX_COMPRESS else ".jsonl"
 DB_FILES = {
-    "movie_source": "db_movie_source.json",
-    "movie_target": "db_movie_target.json",
-    "full_source": "db_full_source.json",
-    "full_target": "db_full_target.json",
-    "history": "history_ids.txt"
+    "movie_source": f"db_movie_source{INDEX_EXT}",
+    "movie_target": f"db_movie_target{INDEX_EXT}",
+    "full_source": f"db_full_source{INDEX_EXT}",
+    "full_target": f"db_full_target{INDEX_EXT}",
+    "history": "history_ids.txt",
+    "rate_state": "rate_limits.json",
+    "job_journal": "forward_job.journal",
+    "index_state": "index_state.json",
+    "store": "library.db",
+    "dead_letters": "dead_letters.jsonl",
+    "peers": "peers.json",
+    "target_cache": "target_cache.json" # + target_cache.uids.hset / .names.hset (mmap-able)
 }
 
 # --- MEMORY CACHE (EXISTING) ---
@@ -96,69 +128,346 @@ BAD_QUALITY_REGEX = re.compile(r"\b(cam|camrip|hdcam|ts|telesync|tc|pre-dvdrip|s
 QUALITY_CONFIG = {
     "bad_quality": ["cam", "camrip", "hdcam", "ts", "telesync", "tc", "scr", "screener", "pre-dvdrip", "line audio", "sample"],
     "good_quality": ["2160p", "4k", "1080p", "720p", "web-dl", "bluray", "hdrip", "webrip", "imax"],
-    "tiny_keywords": ["hq", "10bit", "hevc", "x265", "psa", "pahe"]
+    "tiny_keywords": ["hq", "10bit", "hevc", "x265", "psa", "pahe"],
+    "scan_batch": 5000 # Snapshot rows normalized per bulk call in /scan_library_dupes
+}
+
+# Token weights used by get_quality_score. Every group adds its best match once;
+# "codec" and "penalty" are filled from tiny_keywords (+1) / bad_quality (-20) when not listed.
+# "resolution" is the base tier and keeps the old source tiers (bluray = 1080p, web-dl/hdrip = 720p)
+# for names without a resolution tag; "source" only breaks ties on top of it.
+QUALITY_SCORES = {
+    "resolution": {"2160p": 20, "4k": 20, "uhd": 20, "1080p": 10, "bluray": 10, "720p": 5, "web-dl": 5, "hdrip": 5,
+                   "480p": 1, "sd": 1},
+    "source": {"remux": 4, "bluray": 4, "web-dl": 3, "webrip": 2, "hdrip": 1, "imax": 1},
+    "codec": {},
+    "penalty": {}
+}
+
+# Fuzzy dedupe (n-gram prefix blocking over the normalized title)
+FUZZY_CONFIG = {
+    "ngram": 3,          # Character shingle length (spaces ignored)
+    "threshold": 0.7,    # Min Jaccard similarity of the shingle sets to merge two titles
+    "max_bucket": 200    # Blocks bigger than this are too generic to be useful and are skipped
 }
 
 # 2️⃣ EDITING CONFIGURATION
 EDIT_CONFIG = {
     "remove": ["@olduser", "t.me/oldlink", "Join request", "Sub please"], # Add keywords to remove
     "replace_with": "", # Set this via ENV or modify here: e.g., "@MyChannel | t.me/MyChannel"
-    "lock_regex": r"(MyLockedChannel|SpecificTag|Verified)" # Content matching this won't be edited
+    "lock_regex": r"(MyLockedChannel|SpecificTag|Verified)", # Content matching this won't be edited
+    "batch": 20 # Edits leased together; their live captions are checked with one get_messages
+}
+
+# Batched forwarding (`batch` flag on /forward_movie & /forward_full)
+FORWARD_CONFIG = {
+    "batch_size": 100   # Message ids per forward call (Telegram limit is 100)
+}
+
+# 3️⃣ RATE LIMIT CONFIGURATION (Adaptive Token Buckets)
+# One bucket per session per method class. Rates are calls/sec and are learned at runtime.
+RATE_CONFIG = {
+    "copy":   {"rate": 3.0, "burst": 5, "min": 0.1, "max": 30.0},   # copy_message / forward_messages (1-100 ids)
+    "edit":   {"rate": 3.0, "burst": 5, "min": 0.1, "max": 30.0},   # edit_message_caption
+    "delete": {"rate": 0.5, "burst": 2, "min": 0.02, "max": 5.0},   # delete_messages (100 ids per call)
+    "read":   {"rate": 2.0, "burst": 4, "min": 0.1, "max": 20.0},   # get_messages (200 ids per call)
+    "increase": 0.1,    # Additive speed-up (calls/sec) spread over one second of successes
+    "decrease": 0.5,    # Multiplicative slow-down on every FloodWait
+    "save_every": 200   # Persist learned rates after this many successes
+}
+
+# Session pool health (parallel start, quarantine, rejoin)
+POOL_CONFIG = {
+    "check_every": 30,      # Seconds between health checks / reconnect attempts of down sessions
+    "window": 50,           # Recent item results kept per session for the error rate
+    "min_samples": 10,      # Results needed before the error rate can quarantine a session
+    "max_error_rate": 0.5,  # Quarantine a session whose recent results fail this often
+    "quarantine": 300,      # Seconds a quarantined session stays out of rotation
+    "stall_timeout": 600    # A job with every session disconnected this long dead-letters what is left
+}
+
+# Peer cache (chat resolution shared by all sessions, persisted in peers.json)
+PEER_CONFIG = {
+    "chat_ttl": 3600,       # Seconds a resolved chat ref (id/title) is reused without get_chat
+    "dialog_scan": 2000     # Dialogs a session walks to find a chat it has no access hash for
+}
+
+# Requests kept in flight per session and method class (pipelined work queue lanes).
+# Calls still pass the rate limiter one by one; the window only overlaps their round trips.
+PIPELINE_CONFIG = {
+    "copy": 4,
+    "edit": 4,
+    "delete": 2,            # Each delete call already carries 100 ids
+    "read": 2
+}
+
+# Retries for delete / edit / forward items (shared work queue)
+RETRY_CONFIG = {
+    "max_attempts": 5,   # After this many failures an item goes to the dead-letter list
+    "base_delay": 2,     # Seconds before the first retry, doubled on every further attempt
+    "max_delay": 300
+}
+# Errors that will not go away on retry; such items are dead-lettered at once
+PERMANENT_ERRORS = (MessageIdInvalid, MessageAuthorRequired, MessageNotModified, ChatAdminRequired)
+
+# 4️⃣ INDEX CONFIGURATION (Incremental Refresh)
+INDEX_CONFIG = {
+    "reconcile_every": 24 * 3600,  # Seconds between deletion checks of an existing index
+    "probe_batch": 200,            # Message ids per get_messages call
+    "write_buffer": 500,           # Records buffered before each append to the index file
+    "cache_merge_every": 100000    # Keys added since the last cache file before it is rewritten
+}
+
+# Forward history (history_ids.txt) journal
+HISTORY_CONFIG = {
+    "flush_interval": 2,       # Seconds between batched append + fsync while a job runs
+    "compact_bytes": 8 * 2**20 # Bytes appended since the last compaction before it is rewritten without duplicates
+}
+
+# 5️⃣ CHANNEL SNAPSHOT CONFIGURATION (Shared by all scanning commands)
+SNAPSHOT_CONFIG = {
+    "max_age": 5 * 60,         # Younger snapshots are used as-is, older ones get an incremental refresh
+    "full_every": 24 * 3600,   # Full rescan interval (catches deletions and caption edits)
+    "batch": 1000,             # Rows written per SQLite transaction
+    "parallel_min": 2000       # Id spans at least this big are fetched by all sessions in parallel
+}
+
+# 6️⃣ MONGODB SYNC CONFIGURATION (Bulk Path)
+MONGO_SYNC_CONFIG = {
+    "collections": ["movies", "collection", "col", "movies_col"], # Attribute names probed on Database()
+    "read_batch": 5000,   # Documents per cursor round trip
+    "delete_batch": 1000  # message_ids per delete_many
 }
 
-# 3️⃣ GLOBAL STATE FOR DRY RUN (Safety First)
-PENDING_STATE = {
-    "action": None, # 'delete_dupes', 'edit_metadata', 'sync_db'
-    "data": [],     # List of IDs or Objects
-    "meta": {},     # Extra info like channel_id
-    "timestamp": 0
+# 7️⃣ METRICS CONFIGURATION (/metrics endpoint + /stats)
+METRICS_CONFIG = {
+    "latency_buckets": [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30], # Seconds, for tg_api_latency_seconds
+    "progress_interval": 3  # Min seconds between two progress edits of one status message
+}
+
+# Profiling (/profile start|stop|status)
+PROFILE_CONFIG = {
+    "sample_interval": 0.005, # Seconds between stack samples of the event loop thread
+    "top": 40,                # Rows per report section
+    "mem_frames": 10          # Traceback depth kept by tracemalloc
+}
+
+# Dry-run plans (written by scans, streamed by /confirm_clean)
+PLAN_CONFIG = {
+    "dir": "plans",         # plan_<id>.jsonl.gz (header + one item per line) + plan_<id>.json (count, sha256, progress)
+    "chunk": 1000,          # Items read and executed per step; progress is saved after each one
+    "max_age": 7 * 86400    # Older plans are refused (Safety First): the channel has moved on, rescan
+}
+
+# 8️⃣ JOB SCHEDULER CONFIGURATION (/jobs, /stop <id>, per-job dry-run plans)
+JOB_CONFIG = {
+    "max_running": 3,       # Jobs running at once; the rest wait in priority order
+    "grace": 60,            # Seconds a stopped job gets to wind down before it is cancelled hard
+    "keep_finished": 20,    # Finished jobs listed by /jobs
+    "weights": {"high": 4, "normal": 2, "low": 1}, # Share of each session's pipeline window
+    "priority": {           # Default priority per job kind (`/prio <id> <level>` to change)
+        "confirm": "high", "forward": "normal", "resume": "normal", "replay": "normal",
+        "index": "low", "scan": "low", "edit_scan": "low", "sync_db": "low", "snapshot": "low"
+    }
 }
 
 # ==============================================================================
 # 🆕 HELPER FUNCTIONS (LOGIC LAYER)
 # ==============================================================================
 
+class TitleNormalizer:
+    """
+    Compiled once from QUALITY_CONFIG: year and quality tags are removed only as
+    whole tokens (so 'ts' no longer eats 'avengers'). Results are memoised in a
+    bounded LRU cache, and everything is rebuilt when QUALITY_CONFIG changes.
+    """
+    def __init__(self, config, cache_size=50000):
+        self.config = config
+        self.cache_size = cache_size
+        self.fingerprint = None
+        self._compile()
+
+    def _config_fingerprint(self):
+        return tuple(tuple(self.config[k]) for k in ("bad_quality", "good_quality", "tiny_keywords"))
+
+    def _compile(self):
+        self.fingerprint = self._config_fingerprint()
+        tags = sorted({t.lower() for group in self.fingerprint for t in group}, key=len, reverse=True)
+        alternatives = [r"(?:19|20)\d{2}"] + [re.escape(t) for t in tags]
+        self.ext_re = re.compile(r"\.[a-z0-9]{3,4}$")
+        self.sep_re = re.compile(r"[._]+")
+        self.tag_re = re.compile(r"(?<![a-z0-9])(?:" + "|".join(alternatives) + r")(?![a-z0-9])")
+        self.junk_re = re.compile(r"[^a-z0-9\s]")
+        self.space_re = re.compile(r"\s+")
+        self._cached = lru_cache(maxsize=self.cache_size)(self._normalize)
+
+    def _normalize(self, title):
+        text = self.ext_re.sub("", title.lower())
+        text = self.sep_re.sub(" ", text)
+        text = self.tag_re.sub(" ", text)
+        text = self.junk_re.sub("", text)
+        return self.space_re.sub(" ", text).strip()
+
+    def refresh(self):
+        if self._config_fingerprint() != self.fingerprint: self._compile()
+
+    def normalize(self, title):
+        if not title: return ""
+        self.refresh()
+        return self._cached(title)
+
+    def normalize_many(self, titles):
+        """Bulk API: one config check for the whole batch, identical titles normalised once."""
+        self.refresh()
+        cached = self._cached
+        return [cached(t) if t else "" for t in titles]
+
+TITLE_NORMALIZER = TitleNormalizer(QUALITY_CONFIG)
+
 def normalize_title(title):
     """
     Cleans title to find duplicates regardless of quality/year.
     Ex: 'Spider-Man: No Way Home (2021) 1080p.mkv' -> 'spiderman no way home'
     """
-    if not title: return ""
-    text = title.lower()
-    # Remove file extension
-    text = re.sub(r'\.[a-z0-9]{3,4}$', '', text)
-    # Remove years (1990-2029)
-    text = re.sub(r'\b(19|20)\d{2}\b', '', text)
-    # Remove quality tags from JSON
-    all_tags = QUALITY_CONFIG["bad_quality"] + QUALITY_CONFIG["good_quality"] + QUALITY_CONFIG["tiny_keywords"]
-    for tag in all_tags:
-        text = text.replace(tag, "")
-    # Remove special chars and extra spaces
-    text = re.sub(r'[^a-z0-9\s]', '', text)
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    return TITLE_NORMALIZER.normalize(title)
+
+def normalize_titles(titles):
+    """Normalizes a whole list of titles (e.g. every file name of a scanned index) in one call."""
+    return TITLE_NORMALIZER.normalize_many(titles)
+
+class QualityScorer:
+    """
+    Tokenizes a release name once (words plus joined word pairs, so 'web-dl' and
+    'line audio' match) and sums the best weight per QUALITY_SCORES group.
+    Substrings inside other words ('sd' in 'wednesday') never match.
+    """
+    def __init__(self, table, config, cache_size=50000):
+        self.table = table
+        self.config = config
+        self.cache_size = cache_size
+        self.fingerprint = None
+        self._compile()
+
+    def _config_fingerprint(self):
+        return (json.dumps(self.table, sort_keys=True), tuple(self.config["bad_quality"]), tuple(self.config["tiny_keywords"]))
+
+    def _compile(self):
+        self.fingerprint = self._config_fingerprint()
+        groups = {g: dict(w) for g, w in self.table.items()}
+        for kw in self.config["tiny_keywords"]: groups.setdefault("codec", {}).setdefault(kw.lower(), 1)
+        for kw in self.config["bad_quality"]: groups.setdefault("penalty", {}).setdefault(kw.lower(), -20)
+        self.lookup = {}
+        for group, weights in groups.items():
+            for token, weight in weights.items(): self.lookup.setdefault(token.lower(), []).append((group, weight))
+        self.split_re = re.compile(r"[a-z0-9]+")
+        self._cached = lru_cache(maxsize=self.cache_size)(self._score)
+
+    def tokens(self, text):
+        words = self.split_re.findall(text.lower())
+        pairs = [f"{a}{sep}{b}" for a, b in zip(words, words[1:]) for sep in ("-", " ")]
+        return set(words).union(pairs)
+
+    def _score(self, text):
+        best = {}
+        for token in self.tokens(text):
+            for group, weight in self.lookup.get(token, ()):
+                cur = best.get(group)
+                # Positive groups keep their highest weight, penalties their harshest
+                if cur is None or (weight > cur if weight >= 0 else weight < cur): best[group] = weight
+        return sum(best.values())
+
+    def refresh(self):
+        if self._config_fingerprint() != self.fingerprint: self._compile()
+
+    def score(self, filename, caption=""):
+        self.refresh()
+        return self._cached(f"{filename or ''} {caption or ''}")
+
+    def score_many(self, pairs):
+        """Vectorised path: scores a whole index of (filename, caption) pairs with one config check."""
+        self.refresh()
+        cached = self._cached
+        return [cached(f"{fn or ''} {cap or ''}") for fn, cap in pairs]
+
+QUALITY_SCORER = QualityScorer(QUALITY_SCORES, QUALITY_CONFIG)
 
 def get_quality_score(filename, caption):
     """
     Calculates a Quality Score. Higher is better.
-    Hierarchy: 4K (20) > 1080p (10) > 720p (5) > Tiny (Add 1) > Bad (-10)
+    Hierarchy: 4K (20) > 1080p (10) > 720p (5) > Source / Tiny bonus > Bad (-20)
     """
-    text = (str(filename) + " " + str(caption)).lower()
-    score = 0
-    
-    # Base Score by Resolution/Source
-    if any(k in text for k in ["2160p", "4k"]): score += 20
-    elif any(k in text for k in ["1080p", "bluray"]): score += 10
-    elif any(k in text for k in ["720p", "web-dl", "hdrip"]): score += 5
-    elif any(k in text for k in ["480p", "sd"]): score += 1
-    
-    # Bonus for efficient encoding
-    if any(k in text for k in QUALITY_CONFIG["tiny_keywords"]): score += 1
-    
-    # Penalty for bad quality
-    if any(k in text for k in QUALITY_CONFIG["bad_quality"]): score -= 20
-    
-    return score
+    return QUALITY_SCORER.score(filename, caption)
+
+def score_index(records):
+    """Scores a batch of scanned records ({"file_name"/"name"/"fname", "caption"}) in one call."""
+    return QUALITY_SCORER.score_many((r.get("file_name") or r.get("name") or r.get("fname"), r.get("caption")) for r in records)
+
+def find_fuzzy_clusters(titles, config=FUZZY_CONFIG):
+    """
+    Groups near-identical normalized titles ('spider man no way home' ~ 'spiderman no way home').
+    Blocking uses prefix filtering over character n-grams: each title is indexed only under
+    its rarest grams, and two titles with Jaccard >= threshold are guaranteed to share one of
+    them. Only titles sharing a block get compared, so the cost stays roughly linear.
+    Titles with different numbers (sequels, years left in the name) are never merged.
+    Returns a list of (titles, min_similarity) for every cluster with 2+ titles.
+    """
+    n, threshold = config["ngram"], config["threshold"]
+    digit_re = re.compile(r"\d+")
+
+    shingles, numbers = [], []
+    freq = {}
+    for title in titles:
+        compact = title.replace(" ", "")
+        grams = frozenset(compact[i:i + n] for i in range(max(1, len(compact) - n + 1)))
+        shingles.append(grams)
+        numbers.append(frozenset(digit_re.findall(title)))
+        for g in grams: freq[g] = freq.get(g, 0) + 1
+
+    parent = list(range(len(titles)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Titles are probed smallest first against blocks of already-seen titles; block heads
+    # that are too small to reach the threshold are dropped for good (size filter).
+    sizes = [len(g) for g in shingles]
+    blocks, heads = {}, {}
+    similarity = {}
+    for i in sorted(range(len(titles)), key=sizes.__getitem__):
+        grams, size = shingles[i], sizes[i]
+        ordered = sorted(grams, key=lambda g: (freq[g], g))
+        probe_len = size - math.ceil(threshold * size) + 1
+        # Later titles are never smaller, so a shorter prefix is enough for the index itself
+        index_len = size - math.ceil(2 * threshold / (1 + threshold) * size) + 1
+        min_size = threshold * size
+        candidates = set()
+        for pos, g in enumerate(ordered[:probe_len]):
+            block = blocks.get(g)
+            if block:
+                head = heads.get(g, 0)
+                while head < len(block) and sizes[block[head]] < min_size: head += 1
+                heads[g] = head
+                if len(block) - head <= config["max_bucket"]: candidates.update(block[head:])
+            if pos < index_len: blocks.setdefault(g, []).append(i)
+        for j in candidates:
+            if numbers[i] != numbers[j]: continue
+            inter = len(grams & shingles[j])
+            sim = inter / (size + sizes[j] - inter)
+            if sim >= threshold:
+                ri, rj = find(i), find(j)
+                if ri != rj: parent[ri] = rj
+                similarity[(i, j)] = sim
+
+    clusters = {}
+    for i in range(len(titles)): clusters.setdefault(find(i), []).append(i)
+    min_sim = {}
+    for (i, j), sim in similarity.items():
+        root = find(i)
+        min_sim[root] = min(min_sim.get(root, 1.0), sim)
+    return [([titles[i] for i in members], min_sim.get(root, 1.0))
+            for root, members in clusters.items() if len(members) > 1]
 
 def get_file_size_bytes(m):
     media = m.video or m.document
@@ -167,49 +476,831 @@ def get_file_size_bytes(m):
 def only_admin(_, __, m):
     return m.from_user and m.from_user.id == ADMIN_ID
 
+# ==============================================================================
+# 🆕 ADAPTIVE RATE LIMITER (PER SESSION, PER METHOD CLASS)
+# ==============================================================================
+
+class TokenBucket:
+    """Token bucket whose refill rate is tuned by AdaptiveRateLimiter."""
+    def __init__(self, rate, burst, min_rate, max_rate):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await job_sleep(self.blocked_until - now) # FloodWait ban: a stopped job stops waiting
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await job_sleep((1 - self.tokens) / self.rate)
+
+class AdaptiveRateLimiter:
+    """
+    AIMD limiter: every success nudges the rate up, every FloodWait halves it
+    and blocks the bucket for the requested time. Learned rates survive restarts.
+    """
+    def __init__(self, config, state_file):
+        self.config = config
+        self.state_file = state_file
+        self.buckets = {}
+        self.learned = {}
+        self.successes = 0
+        if os.path.exists(state_file):
+            try:
+                with open(state_file, "r") as f: self.learned = json.load(f)
+            except: self.learned = {}
+
+    def bucket(self, client, kind):
+        key = f"{client.name}:{kind}"
+        if key not in self.buckets:
+            cfg = self.config[kind]
+            rate = min(cfg["max"], max(cfg["min"], self.learned.get(key, cfg["rate"])))
+            self.buckets[key] = TokenBucket(rate, cfg["burst"], cfg["min"], cfg["max"])
+        return self.buckets[key]
+
+    async def acquire(self, client, kind):
+        await self.bucket(client, kind).acquire()
+
+    def success(self, client, kind):
+        b = self.bucket(client, kind)
+        b.rate = min(b.max_rate, b.rate + self.config["increase"] / max(b.rate, 1.0))
+        self.successes += 1
+        if self.successes % self.config["save_every"] == 0: self.save()
+
+    def flood(self, client, kind, seconds):
+        b = self.bucket(client, kind)
+        b.rate = max(b.min_rate, b.rate * self.config["decrease"])
+        b.tokens = 0.0
+        b.blocked_until = max(b.blocked_until, time.monotonic() + seconds + 1)
+        POOL.flood(client, seconds) # Keep the session from leasing new work while banned
+        self.save()
+
+    def save(self):
+        for key, b in self.buckets.items(): self.learned[key] = round(b.rate, 4)
+        try:
+            with open(self.state_file, "w") as f: json.dump(self.learned, f)
+        except Exception as e: print(f"Rate state save failed: {e}")
+
+RATE_LIMITER = AdaptiveRateLimiter(RATE_CONFIG, DB_FILES["rate_state"])
+
+# ==============================================================================
+# 📈 METRICS & TELEMETRY (PROMETHEUS TEXT FORMAT)
+# ==============================================================================
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms keyed by (name, labels).
+    Written from the bot loop, read by the Flask thread, hence the lock.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        k = self.key(name, labels)
+        with self.lock: self.counters[k] = self.counters.get(k, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock: self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        k = self.key(name, labels)
+        with self.lock:
+            h = self.histograms.get(k)
+            if h is None: h = self.histograms[k] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, le in enumerate(self.buckets):
+                if value <= le: h["buckets"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+
+    def total(self, name, **match):
+        """Sum of a counter over all label sets that contain `match`."""
+        want = {(k, str(v)) for k, v in match.items()}
+        with self.lock: return sum(v for (n, labels), v in self.counters.items() if n == name and want <= set(labels))
+
+    def by_label(self, name, label, source="counters"):
+        """{label value: summed counter} (or {value: histogram} merged) for one metric."""
+        out = {}
+        with self.lock:
+            for (n, labels), v in getattr(self, source).items():
+                if n != name: continue
+                lv = dict(labels).get(label)
+                if source == "histograms":
+                    o = out.setdefault(lv, {"sum": 0.0, "count": 0})
+                    o["sum"] += v["sum"]
+                    o["count"] += v["count"]
+                else: out[lv] = out.get(lv, 0) + v
+        return out
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs: return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+        lines = []
+        with self.lock:
+            for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+                seen = set()
+                for (name, labels), v in sorted(store.items()):
+                    if name not in seen:
+                        seen.add(name)
+                        lines.append(f"# TYPE {name} {kind}")
+                    lines.append(f"{name}{fmt(labels)} {v}")
+            seen = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                for le, c in zip(self.buckets, h["buckets"]): lines.append(f"{name}_bucket{fmt(labels, [('le', le)])} {c}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h['count']}")
+                lines.append(f"{name}_sum{fmt(labels)} {h['sum']}")
+                lines.append(f"{name}_count{fmt(labels)} {h['count']}")
+        lines.append("# TYPE bot_uptime_seconds gauge")
+        lines.append(f"bot_uptime_seconds {time.time() - self.started}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics(METRICS_CONFIG["latency_buckets"])
+
+def telemetry_report():
+    """Per-session API usage and per-job item counts for /stats (full detail is on /metrics)."""
+    calls = METRICS.by_label("tg_api_calls_total", "session")
+    errors = METRICS.by_label("tg_api_errors_total", "session")
+    flood = METRICS.by_label("tg_floodwait_seconds_total", "session")
+    latency = METRICS.by_label("tg_api_latency_seconds", "session", source="histograms")
+    lines = ["\n\n📈 **Sessions** (calls / errors / flood s / avg ms)"]
+    for cl in ALL_CLIENTS:
+        h = latency.get(cl.name, {"sum": 0, "count": 0})
+        avg = h["sum"] / h["count"] * 1000 if h["count"] else 0
+        lines.append(f"`{cl.name}`: {calls.get(cl.name, 0)} / {errors.get(cl.name, 0)} / {flood.get(cl.name, 0)} / {avg:.0f}")
+    items = METRICS.by_label("bot_items_processed_total", "job")
+    failed = METRICS.by_label("bot_items_failed_total", "job")
+    if items or failed:
+        lines.append("\n🧮 **Jobs** (done / failed attempts)")
+        for job in sorted(set(items) | set(failed)): lines.append(f"`{job}`: {items.get(job, 0)} / {failed.get(job, 0)}")
+    return "\n".join(lines)
+
+class ProgressReporter:
+    """
+    Wraps a status message. update() is coalesced: at most one edit per
+    METRICS_CONFIG["progress_interval"], latest text wins, sent in the background so
+    workers never wait on it. edit() is for phase/final messages: it drops any
+    pending update and edits right away.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.pending = None
+        self.last = 0
+        self.task = None
+
+    def update(self, text):
+        if self.pending is not None: METRICS.inc("bot_status_edits_total", mode="coalesced")
+        self.pending = text
+        if self.task is None or self.task.done(): self.task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        while self.pending is not None:
+            wait = self.last + METRICS_CONFIG["progress_interval"] - time.monotonic()
+            if wait > 0: await asyncio.sleep(wait)
+            text, self.pending = self.pending, None
+            if text is None: return
+            self.last = time.monotonic()
+            METRICS.inc("bot_status_edits_total", mode="progress")
+            try: await self.message.edit(text)
+            except FloodWait as e: self.last += e.value # Skip updates until the wait is over
+            except Exception: pass
+
+    async def edit(self, text, **kwargs):
+        self.pending = None
+        if self.task and not self.task.done(): self.task.cancel()
+        self.last = time.monotonic()
+        METRICS.inc("bot_status_edits_total", mode="final")
+        return await self.message.edit(text, **kwargs)
+
+# ==============================================================================
+# 🔬 ON-DEMAND PROFILING (INSIDE THE RUNNING PROCESS)
+# ==============================================================================
+
+class PhaseTimer:
+    """Splits a job into named phases: mark("fetch") closes the phase that just ran."""
+    def __init__(self, job):
+        self.job = job
+        self.phases = []
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        METRICS.observe("bot_phase_seconds", now - self.last, job=self.job, phase=phase)
+        self.last = now
+
+    def done(self):
+        PROFILER.phases[self.job] = {"at": time.time(), "phases": self.phases}
+
+class StackSampler(threading.Thread):
+    """Samples the event loop thread's stack; leaf frames in selectors = waiting on the network."""
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.running = True
+        self.samples = 0
+        self.idle = 0
+        self.leaves = {}
+        self.stacks = {}
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples += 1
+                leaf = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+                if frame.f_code.co_filename.endswith("selectors.py"): self.idle += 1
+                else:
+                    self.leaves[leaf] = self.leaves.get(leaf, 0) + 1
+                    stack = []
+                    while frame is not None and len(stack) < 12:
+                        stack.append(frame.f_code.co_name)
+                        frame = frame.f_back
+                    key = ";".join(reversed(stack))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+class JobProfiler:
+    """cProfile + stack sampling + tracemalloc, switched on and off from admin commands."""
+    def __init__(self, config):
+        self.config = config
+        self.phases = {}
+        self.modes = set()
+        self.started = 0
+        self.cpu = None
+        self.sampler = None
+
+    def start(self, modes):
+        if self.modes: raise RuntimeError(f"Profiler already running: {', '.join(sorted(self.modes))}")
+        self.modes = set(modes)
+        self.started = time.time()
+        if "cpu" in self.modes:
+            self.cpu = cProfile.Profile()
+            self.cpu.enable()
+        if "sample" in self.modes:
+            self.sampler = StackSampler(threading.get_ident(), self.config["sample_interval"])
+            self.sampler.start()
+        if "mem" in self.modes and not tracemalloc.is_tracing(): tracemalloc.start(self.config["mem_frames"])
+
+    def stop(self, path):
+        """Stops everything and writes the text report to `path` (plus `path`.prof for cProfile)."""
+        if not self.modes: raise RuntimeError("Profiler is not running")
+        top = self.config["top"]
+        out = io.StringIO()
+        out.write(f"Profile: {', '.join(sorted(self.modes))} | {time.time() - self.started:.1f}s\n\n")
+        out.write(self.phase_report())
+        if self.sampler:
+            self.sampler.running = False
+            self.sampler.join()
+            sm = self.sampler
+            busy = sm.samples - sm.idle
+            out.write(f"\n=== Stack samples: {sm.samples} every {sm.interval}s ===\n")
+            if sm.samples: out.write(f"Python busy: {busy / sm.samples:.1%} | waiting on network/timers: {sm.idle / sm.samples:.1%}\n")
+            out.write("\n-- Hottest frames (busy samples) --\n")
+            for leaf, n in sorted(sm.leaves.items(), key=lambda x: -x[1])[:top]: out.write(f"{n:>7}  {leaf}\n")
+            out.write("\n-- Hottest stacks --\n")
+            for stack, n in sorted(sm.stacks.items(), key=lambda x: -x[1])[:top]: out.write(f"{n:>7}  {stack}\n")
+        if self.cpu:
+            self.cpu.disable()
+            self.cpu.dump_stats(path + ".prof")
+            out.write("\n=== cProfile (cumulative) ===\n")
+            pstats.Stats(self.cpu, stream=out).sort_stats("cumulative").print_stats(top)
+        if "mem" in self.modes and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            out.write(f"\n=== tracemalloc: current {current / 2**20:.1f} MB | peak {peak / 2**20:.1f} MB ===\n")
+            for stat in tracemalloc.take_snapshot().statistics("lineno")[:top]: out.write(f"{stat}\n")
+            tracemalloc.stop()
+        with open(path, "w") as f: f.write(out.getvalue())
+        self.modes, self.cpu, self.sampler = set(), None, None
+        return path
+
+    def phase_report(self):
+        out = "=== Phase timings (latest run per job) ===\n"
+        for job, run in self.phases.items():
+            parts = " | ".join(f"{phase} {sec:.2f}s" for phase, sec in run["phases"])
+            out += f"{job} @ {time.strftime('%H:%M:%S', time.localtime(run['at']))}: {parts}\n"
+        return out
+
+PROFILER = JobProfiler(PROFILE_CONFIG)
+
+# ==============================================================================
+# ⏱️ JOB SCHEDULER (CONCURRENT JOBS, CANCEL TOKENS, PER-JOB PLANS)
+# ==============================================================================
+
+CURRENT_JOB = contextvars.ContextVar("current_job", default=None)
+
+class JobCancelled(BaseException):
+    """
+    Raised by job_sleep once the current job is stopped. A BaseException on purpose:
+    the workers' `except Exception` item handling must never count it as a failed item.
+    """
+
+class Job:
+    def __init__(self, job_id, kind, title, factory, priority, keys):
+        self.id = job_id
+        self.kind = kind
+        self.title = title
+        self.factory = factory
+        self.priority = priority
+        self.keys = set(keys)
+        self.state = "queued" # queued -> running -> done | failed | cancelled
+        self.cancel_event = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.queues = 0 # run_work_queue calls in progress, for the lane split
+        self.created = time.time()
+        self.started = self.ended = None
+        self.task = None
+        self.error = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+def job_running():
+    """False once the job this code runs in was stopped (always True outside a job)."""
+    job = CURRENT_JOB.get()
+    return job is None or not job.cancelled
+
+async def job_sleep(seconds):
+    """asyncio.sleep that ends early with JobCancelled when the current job is stopped."""
+    job = CURRENT_JOB.get()
+    if job is None: return await asyncio.sleep(seconds)
+    if job.cancelled: raise JobCancelled()
+    try: await asyncio.wait_for(job.cancel_event.wait(), seconds)
+    except asyncio.TimeoutError: return
+    raise JobCancelled()
+
+class JobScheduler:
+    """
+    Runs commands as concurrent jobs. Every job has an id, a priority and a cancel token
+    (CURRENT_JOB, a context variable inherited by every task the job spawns). Up to
+    JOB_CONFIG["max_running"] jobs run at once and the rest wait by priority. Jobs that
+    share a key (same chat, index file, forward journal) never run side by side.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.jobs = {}
+        self.next_id = 1
+
+    def active(self):
+        return [j for j in self.jobs.values() if j.state in ("queued", "running")]
+
+    def conflict(self, keys):
+        keys = set(keys)
+        return next((j for j in self.active() if j.keys & keys), None)
+
+    def submit(self, kind, title, factory, keys=(), priority=None):
+        job = Job(self.next_id, kind, title, factory, priority or self.config["priority"].get(kind, "normal"), keys)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self._pump()
+        return job
+
+    def _pump(self):
+        weights = self.config["weights"]
+        running = sum(1 for j in self.jobs.values() if j.state == "running")
+        queued = sorted((j for j in self.jobs.values() if j.state == "queued"), key=lambda j: (-weights[j.priority], j.id))
+        for job in queued[:max(0, self.config["max_running"] - running)]:
+            job.state = "running"
+            job.started = time.time()
+            job.task = asyncio.ensure_future(self._run(job))
+
+    async def _run(self, job):
+        CURRENT_JOB.set(job)
+        try:
+            await job.factory()
+            job.state = "cancelled" if job.cancelled else "done"
+        except (JobCancelled, asyncio.CancelledError): job.state = "cancelled"
+        except Exception as e:
+            job.state, job.error = "failed", repr(e)
+            print(f"❌ Job #{job.id} ({job.title}) failed: {e}")
+        finally: self._finish(job)
+
+    def _finish(self, job):
+        job.ended = time.time()
+        job.finished.set()
+        METRICS.inc("bot_jobs_total", kind=job.kind, state=job.state)
+        ended = sorted((j for j in self.jobs.values() if j.ended), key=lambda j: j.ended)
+        for j in ended[:-self.config["keep_finished"]]: del self.jobs[j.id]
+        self._pump()
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job or job.state not in ("queued", "running"): return False
+        job.cancel_event.set()
+        if job.state == "queued":
+            job.state = "cancelled"
+            self._finish(job)
+            return True
+        # Sleeps end at once and loops stop between API calls; a job still busy after the grace period is cancelled hard
+        asyncio.get_running_loop().call_later(self.config["grace"], lambda: job.task.done() or job.task.cancel())
+        return True
+
+    async def wait(self, job):
+        await job.finished.wait()
+        return job
+
+    def lanes(self, window):
+        """Lanes per session for the current job: the window split by priority weight between jobs in a work queue."""
+        job = CURRENT_JOB.get()
+        busy = [j for j in self.jobs.values() if j.state == "running" and j.queues]
+        if job is None or len(busy) < 2: return window
+        weights = self.config["weights"]
+        return max(1, round(window * weights[job.priority] / sum(weights[j.priority] for j in busy)))
+
+    def report_text(self):
+        now = time.time()
+        icons = {"running": "🟢", "queued": "🕒", "done": "✅", "failed": "❌", "cancelled": "⏹️"}
+        lines = []
+        for j in sorted(self.jobs.values(), key=lambda j: (j.state not in ("queued", "running"), -j.id)):
+            age = int((j.ended or now) - (j.started or j.created))
+            note = " | stopping" if j.cancelled and j.state == "running" else (f" | {j.error[:60]}" if j.error else "")
+            lines.append(f"{icons[j.state]} `#{j.id}` {j.title} | {j.priority} | {j.state} {age}s{note}")
+        return "\n".join(lines) or "No jobs."
+
+JOBS = JobScheduler(JOB_CONFIG)
+
+async def start_job(m, kind, factory, keys=()):
+    """Submits a job for command message m; refuses it if a running job shares a key."""
+    busy = JOBS.conflict(keys)
+    if busy:
+        await m.reply(f"⚠️ Job `#{busy.id}` ({busy.title}) is already working on this. See `/jobs`.")
+        return None
+    job = JOBS.submit(kind, " ".join(m.command), factory, keys)
+    await m.reply(f"🆔 Job `#{job.id}` {job.state}" + (" (waiting for a free slot)" if job.state == "queued" else "") + f" | `/stop {job.id}`")
+    return job
+
+def job_command(kind, keys=None):
+    """Runs the decorated command handler as a scheduled job; keys(m) (sync or async) names what it works on."""
+    def wrap(func):
+        @wraps(func)
+        async def handler(c, m):
+            job_keys = keys(m) if keys else ()
+            if asyncio.iscoroutine(job_keys): job_keys = await job_keys
+            return await start_job(m, kind, lambda: func(c, m), job_keys)
+        return handler
+    return wrap
+
+async def chat_keys(m):
+    """Keys a job on the resolved chat id, so `@name`, a link and `-100…` for one chat conflict."""
+    keys = []
+    for ref in m.command[1:2]:
+        try: keys.append(("chat", (await resolve_chat_id(app, ref)).id))
+        except Exception: keys.append(("chat", ref.lower())) # Unresolvable: the command reports it
+    return keys
+
 # ==============================================================================
 # 🆕 5-CORE PARALLEL ENGINES (WORKERS)
 # ==============================================================================
 
+class SessionPool:
+    """
+    Health view over ALL_CLIENTS (same list object). Starts every session at once,
+    tracks per session: connected, FloodWait ban until T, recent error rate. A session
+    failing too often is quarantined; down sessions are restarted by monitor() and
+    rejoin running jobs on their own, since work queue runners wait instead of exiting.
+    """
+    def __init__(self, clients, config):
+        self.clients = clients
+        self.config = config
+        self.health = {}
+
+    def state(self, client):
+        if client.name not in self.health:
+            self.health[client.name] = {"flood_until": 0, "quarantined_until": 0, "last_error": None,
+                                        "results": deque(maxlen=self.config["window"])}
+        return self.health[client.name]
+
+    def is_healthy(self, client):
+        st = self.state(client)
+        now = time.time()
+        return client.is_connected and st["flood_until"] <= now and st["quarantined_until"] <= now
+
+    def healthy(self):
+        return [cl for cl in self.clients if self.is_healthy(cl)]
+
+    def recovers_at(self):
+        """Earliest time a connected session leaves its flood ban / quarantine, None if all are down."""
+        waits = [max(self.state(cl)["flood_until"], self.state(cl)["quarantined_until"])
+                 for cl in self.clients if cl.is_connected]
+        return min(waits) if waits else None
+
+    def flood(self, client, seconds):
+        st = self.state(client)
+        st["flood_until"] = max(st["flood_until"], time.time() + seconds)
+
+    def report(self, client, ok, errors, last_error=None):
+        """Feeds item results into the session's error rate; quarantines it past the limit."""
+        st = self.state(client)
+        st["results"].extend([1] * ok + [0] * errors)
+        if last_error: st["last_error"] = last_error
+        res = st["results"]
+        if len(res) >= self.config["min_samples"] and 1 - sum(res) / len(res) >= self.config["max_error_rate"]:
+            st["quarantined_until"] = time.time() + self.config["quarantine"]
+            res.clear()
+            METRICS.inc("bot_session_quarantined_total", session=client.name)
+            print(f"[{client.name}] 🚑 Quarantined for {self.config['quarantine']}s: {st['last_error']}")
+
+    async def start(self, client):
+        try:
+            await client.start()
+            await PEERS.restore(client)
+            print(f"[{client.name}] ✅ Started")
+        except Exception as e:
+            self.state(client)["last_error"] = repr(e)
+            print(f"[{client.name}] ❌ Start failed: {e}")
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(self.config["check_every"])
+            for cl in self.clients:
+                if not cl.is_connected: await self.start(cl)
+                METRICS.set("bot_session_healthy", int(self.is_healthy(cl)), session=cl.name)
+
+    async def run(self):
+        """compose() replacement: parallel start that survives bad sessions, health monitor, idle, stop."""
+        await asyncio.gather(*[self.start(cl) for cl in self.clients])
+        monitor = asyncio.ensure_future(self.monitor())
+        try: await idle()
+        finally:
+            monitor.cancel()
+            await asyncio.gather(*[cl.stop() for cl in self.clients if cl.is_connected], return_exceptions=True)
+
+    def report_text(self):
+        now = time.time()
+        lines = []
+        for cl in self.clients:
+            st = self.state(cl)
+            if not cl.is_connected: state = "🔴 down"
+            elif st["quarantined_until"] > now: state = f"🚑 quarantined {int(st['quarantined_until'] - now)}s"
+            elif st["flood_until"] > now: state = f"⏳ flood {int(st['flood_until'] - now)}s"
+            else: state = "🟢 up"
+            res = st["results"]
+            rate = f"{1 - sum(res) / len(res):.0%}" if res else "-"
+            lines.append(f"`{cl.name}`: {state} | err {rate}" + (f" | {st['last_error'][:60]}" if st["last_error"] else ""))
+        return "\n".join(lines)
+
+POOL = SessionPool(ALL_CLIENTS, POOL_CONFIG)
+
+class ChatUnreachable(Exception):
+    """No session could reach a chat a work queue needs; its unfinished items were not tried."""
+
+async def run_work_queue(items, handler, batch_size=1, job="work", chats=(), window=1):
+    """
+    Runs items in batches on every POOL session. handler(client, batch, session_name) returns
+    (done_count, [(item, reason, retryable)]). Returns (done, dead) with dead = [(item, reason, attempts)].
+    """
+    queue = asyncio.Queue()
+    for i in range(0, len(items), batch_size): queue.put_nowait((items[i:i + batch_size], 0))
+    loop = asyncio.get_running_loop()
+    dead = []
+    state = {"inflight": 0, "stalled_since": None, "unreachable": False}
+    retries = {} # id -> (batch, attempts, timer handle)
+
+    def retry_later(batch, attempts): # Exponential backoff, then whichever session is free takes it
+        delay = min(RETRY_CONFIG["max_delay"], RETRY_CONFIG["base_delay"] * 2 ** (attempts - 1))
+        key = id(batch)
+        def push():
+            retries.pop(key, None)
+            queue.put_nowait((batch, attempts))
+        retries[key] = (batch, attempts, loop.call_later(delay, push))
+
+    def fail(batch, attempts, failed): # Dead after RETRY_CONFIG["max_attempts"], or at once if not retryable
+        attempts += 1
+        retry = []
+        for item, reason, retryable in failed:
+            if retryable and attempts < RETRY_CONFIG["max_attempts"]: retry.append(item)
+            else: dead.append((item, reason, attempts))
+        if retry: retry_later(retry, attempts)
+
+    def finished():
+        return queue.empty() and not retries and not state["inflight"]
+
+    async def runner(client, session_name, lane):
+        done = 0
+        try:
+            while job_running() and not finished():
+                # Only healthy sessions lease, so a returning session simply starts leasing again.
+                # Bans / quarantines are waited out; only all sessions down for stall_timeout gives up
+                if not POOL.is_healthy(client):
+                    if POOL.healthy() or POOL.recovers_at(): state["stalled_since"] = None
+                    elif state["stalled_since"] is None: state["stalled_since"] = time.time()
+                    elif time.time() - state["stalled_since"] > POOL_CONFIG["stall_timeout"]: break
+                    await job_sleep(1)
+                    continue
+                if chats and not await PEERS.warm(client, chats): # Instead of failing every item with PeerIdInvalid
+                    if lane == 0: print(f"[{session_name}] 🚫 Cannot reach {list(chats)}, sitting this job out")
+                    state["unreachable"] = True
+                    break
+                # `window` lanes per session, each leasing its own batch; side-by-side jobs split them by priority
+                if lane >= JOBS.lanes(window): # Another job holds this lane for now
+                    await job_sleep(0.5)
+                    continue
+                try: batch, attempts = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    await job_sleep(0.5)
+                    continue
+                METRICS.set("bot_queue_depth", queue.qsize() + len(retries), job=job)
+                state["inflight"] += 1
+                lanes[client.name] += 1
+                METRICS.set("bot_requests_inflight", lanes[client.name], job=job, session=client.name)
+                try: ok, failed = await handler(client, batch, session_name)
+                except JobCancelled: # Stopped mid-batch: not counted
+                    queue.put_nowait((batch, attempts))
+                    raise
+                except FloodWait as e: # Re-raised by the handler: the batch goes back while this session waits
+                    print(f"[{session_name}] ⏳ Flood {e.value}s (batch handed back)")
+                    queue.put_nowait((batch, attempts))
+                    POOL.flood(client, e.value)
+                    continue
+                except Exception as e: # Whole batch counts as a retryable failure
+                    print(f"[{session_name}] Session error: {e}")
+                    POOL.report(client, 0, len(batch), repr(e))
+                    fail(batch, attempts, [(item, repr(e), True) for item in batch])
+                    continue
+                finally:
+                    state["inflight"] -= 1
+                    lanes[client.name] -= 1
+                    METRICS.set("bot_requests_inflight", lanes[client.name], job=job, session=client.name)
+                done += ok
+                POOL.report(client, ok, sum(1 for _, _, retryable in failed if retryable), failed[-1][1] if failed else None)
+                METRICS.inc("bot_items_processed_total", ok, job=job, session=client.name)
+                if not failed: continue
+                METRICS.inc("bot_items_failed_total", len(failed), job=job, session=client.name)
+                fail(batch, attempts, failed)
+        except JobCancelled: pass
+        return done
+
+    lanes = {cl.name: 0 for cl in POOL.clients} # batches in flight per session
+    current = CURRENT_JOB.get()
+    if current: current.queues += 1
+    try:
+        results = await asyncio.gather(*[runner(cl, f"Session-{i+1}", lane)
+                                         for i, cl in enumerate(POOL.clients) for lane in range(max(1, window))])
+    finally:
+        if current: current.queues -= 1
+    unreachable = job_running() and state["unreachable"] and not finished()
+    if not job_running() or unreachable:
+        for _, _, handle in retries.values(): handle.cancel() # Stopped: leave nothing scheduled behind
+        METRICS.set("bot_queue_depth", 0, job=job)
+        # The rest was never tried: the caller keeps it (plan cursor, journal) instead of dead-lettering
+        if unreachable: raise ChatUnreachable(f"No session can reach {', '.join(map(str, chats))}")
+    elif not finished():
+        # Every session stayed down past stall_timeout: nothing will pick these up
+        for batch, attempts, handle in list(retries.values()):
+            handle.cancel()
+            dead.extend((item, "No connected session", attempts) for item in batch)
+        retries.clear()
+        while not queue.empty():
+            batch, attempts = queue.get_nowait()
+            dead.extend((item, "No connected session", attempts) for item in batch)
+    METRICS.set("bot_queue_depth", 0, job=job)
+    if dead: METRICS.inc("bot_items_dead_total", len(dead), job=job)
+    return sum(results), dead
+
 async def parallel_delete_worker(client, message_ids, chat_id, session_name):
-    """Worker to delete messages in batches safely."""
+    """Worker to delete messages in batches safely. Returns (deleted, failed)."""
     deleted_count = 0
+    failed = []
     # Process in chunks of 100 (Telegram limit per call)
     chunks = [message_ids[i:i + 100] for i in range(0, len(message_ids), 100)]
     
-    for chunk in chunks:
-        if not GLOBAL_TASK_RUNNING: break
+    for n, chunk in enumerate(chunks):
+        if not job_running(): break
         try:
+            await RATE_LIMITER.acquire(client, "delete")
             await client.delete_messages(chat_id, chunk)
+            RATE_LIMITER.success(client, "delete")
+            INDEX_STORE.snapshot_delete(chat_id, chunk)
             deleted_count += len(chunk)
-            await asyncio.sleep(2) # Safety delay
         except FloodWait as e:
-            print(f"[{session_name}] ⏳ Sleep {e.value}s")
-            await asyncio.sleep(e.value + 2)
-            # Retry once
-            try: await client.delete_messages(chat_id, chunk)
-            except: pass
+            RATE_LIMITER.flood(client, "delete", e.value)
+            if n == 0: raise # Nothing done yet: hand the whole batch to another session
+            failed.extend((i, f"FloodWait {e.value}s", True) for c in chunks[n:] for i in c)
+            break
         except Exception as e:
             print(f"[{session_name}] Delete Error: {e}")
-    return deleted_count
+            failed.extend((i, repr(e), not isinstance(e, PERMANENT_ERRORS)) for i in chunk)
+    return deleted_count, failed
 
 async def parallel_edit_worker(client, tasks, chat_id, session_name):
-    """Worker to edit captions."""
+    """
+    Worker to edit captions. Returns (edited, failed). Plan items carry the caption
+    they were computed from (old_caption): a message whose live caption differs was
+    edited after the scan and is skipped instead of being overwritten.
+    """
     edited_count = 0
-    for item in tasks:
-        if not GLOBAL_TASK_RUNNING: break
+    failed = []
+    live = {}
+    checked = [t['msg_id'] for t in tasks if "old_caption" in t]
+    if checked:
+        await RATE_LIMITER.acquire(client, "read")
+        try: msgs = await client.get_messages(chat_id, checked)
+        except FloodWait as e:
+            RATE_LIMITER.flood(client, "read", e.value)
+            raise
+        RATE_LIMITER.success(client, "read")
+        live = {msg.id: msg for msg in msgs if msg}
+    for n, item in enumerate(tasks):
+        if not job_running(): break
         msg_id = item['msg_id']
         new_caption = item['new_caption']
+        if "old_caption" in item:
+            msg = live.get(msg_id)
+            current = (msg.caption or "") if msg and not msg.empty else None
+            if current is None:
+                failed.append((item, "Message deleted since the scan", False))
+                continue
+            if current == new_caption: # Already edited (e.g. a resumed plan chunk)
+                edited_count += 1
+                continue
+            if current != item['old_caption']:
+                INDEX_STORE.snapshot_set_caption(chat_id, msg_id, current)
+                failed.append((item, "Caption changed since the scan, rescan to re-plan", False))
+                continue
         try:
+            await RATE_LIMITER.acquire(client, "edit")
             await client.edit_message_caption(chat_id, msg_id, new_caption)
+            RATE_LIMITER.success(client, "edit")
+            INDEX_STORE.snapshot_set_caption(chat_id, msg_id, new_caption)
+            edited_count += 1
+        except MessageNotModified: # Already has this caption (e.g. a resumed plan chunk)
+            INDEX_STORE.snapshot_set_caption(chat_id, msg_id, new_caption)
             edited_count += 1
-            await asyncio.sleep(PER_MSG_DELAY) # Fast but safe
         except FloodWait as e:
-            print(f"[{session_name}] ⏳ Sleep {e.value}s")
-            await asyncio.sleep(e.value + 2)
-        except Exception:
-            pass
-    return edited_count
+            RATE_LIMITER.flood(client, "edit", e.value)
+            if n == 0: raise
+            failed.extend((t, f"FloodWait {e.value}s", True) for t in tasks[n:])
+            break
+        except Exception as e:
+            failed.append((item, repr(e), not isinstance(e, PERMANENT_ERRORS)))
+    return edited_count, failed
+
+# ==============================================================================
+# 🆕 BULK MONGODB SYNC (STREAMING CURSOR + BATCHED DELETES)
+# ==============================================================================
+
+def mongo_collection(db):
+    """Motor-style collection behind Database() (find + delete_many), or None -> legacy per-doc path."""
+    for name in MONGO_SYNC_CONFIG["collections"]:
+        col = getattr(db, name, None)
+        if col is not None and hasattr(col, "find") and hasattr(col, "delete_many"): return col
+    return None
+
+async def stream_channel_refs(col, channel_id):
+    """Yields {message_id, channel_id, imdb_id} for one channel, streamed in cursor batches."""
+    cursor = col.find(
+        {"channel_id": channel_id, "message_id": {"$exists": True}},
+        {"_id": 0, "message_id": 1, "channel_id": 1, "imdb_id": 1},
+        batch_size=MONGO_SYNC_CONFIG["read_batch"]
+    )
+    async for doc in cursor: yield doc
+
+async def load_channel_refs(col, channel_id):
+    """{message_id: message_id} for one channel, without holding whole documents in memory."""
+    refs = {}
+    async for doc in stream_channel_refs(col, channel_id):
+        if doc.get("message_id"): refs[doc["message_id"]] = doc["message_id"]
+    return refs
+
+async def bulk_delete_orphans(col, channel_id, msg_ids, status=None):
+    """Deletes orphan entries with one delete_many per batch. Returns the deleted count."""
+    deleted = 0
+    step = MONGO_SYNC_CONFIG["delete_batch"]
+    for i in range(0, len(msg_ids), step):
+        if not job_running(): break
+        r = await col.delete_many({"channel_id": channel_id, "message_id": {"$in": msg_ids[i:i + step]}})
+        deleted += r.deleted_count
+        if status: status.update(f"🗑️ **Deleting from DB...**\n{min(i + step, len(msg_ids))}/{len(msg_ids)}")
+    return deleted
 
 # ==============================================================================
 # 🆕 COMMANDS (NEW FEATURES)
@@ -217,49 +1308,59 @@ async def parallel_edit_worker(client, tasks, chat_id, session_name):
 
 # --- 1. SMART LIBRARY DUPLICATE SCANNER ---
 @app.on_message(filters.command("scan_library_dupes") & filters.create(only_admin))
+@job_command("scan", chat_keys)
 async def scan_dupes_cmd(c, m):
-    global PENDING_STATE, GLOBAL_TASK_RUNNING
-    if len(m.command) < 2: return await m.reply("Usage: `/scan_library_dupes @channel`")
+    if len(m.command) < 2: return await m.reply("Usage: `/scan_library_dupes @channel [fuzzy]`")
     
     chat_ref = m.command[1]
-    status = await m.reply(f"🧠 **Initializing Smart Scan for {chat_ref}...**\nFetching Library Index...")
-    GLOBAL_TASK_RUNNING = True
+    fuzzy = len(m.command) > 2 and m.command[2].lower() == "fuzzy"
+    status = ProgressReporter(await m.reply(f"🧠 **Initializing Smart Scan for {chat_ref}...**\nFetching Library Index..."))
+    timer = PhaseTimer("scan_dupes")
     
     try:
-        chat = await c.get_chat(chat_ref)
+        chat = await resolve_chat_id(c, chat_ref)
+        _, complete = await refresh_snapshot(c, chat.id, status)
+        if not complete: # Unfetched ranges hide copies: the "best" one could be missing
+            return await status.edit("❌ Channel scan incomplete (failed ranges or stopped). No plan created, retry later.")
+        timer.mark("fetch")
         library = {} # Key: normalized_name, Value: List of movie objects
         
         count = 0
-        async for msg in c.get_chat_history(chat.id):
-            if not GLOBAL_TASK_RUNNING: break
-            if not (msg.video or msg.document): continue
+        rows = INDEX_STORE.snapshot_rows(chat.id, media_only=True)
+        while job_running():
+            batch = list(islice(rows, QUALITY_CONFIG["scan_batch"]))
+            if not batch: break
             
-            # Extract Info
-            media = msg.video or msg.document
-            fname = getattr(media, 'file_name', "") or ""
-            caption = msg.caption or ""
-            
-            # Normalize
-            norm_name = normalize_title(fname)
-            if not norm_name: continue
-            
-            score = get_quality_score(fname, caption)
-            size = getattr(media, 'file_size', 0)
-            
-            obj = {
-                "msg_id": msg.id,
-                "score": score,
-                "size": size,
-                "fname": fname
-            }
-            
-            if norm_name not in library: library[norm_name] = []
-            library[norm_name].append(obj)
-            
-            count += 1
-            if count % 1000 == 0:
-                try: await status.edit(f"🔍 **Scanning...**\nFound: {count} Files\nUnique Titles: {len(library)}")
-                except: pass
+            # Normalize and score the whole batch at once (one config check, repeated names done once)
+            titles = normalize_titles([row["file_name"] for row in batch])
+            scores = score_index(batch)
+            for row, norm_name, score in zip(batch, titles, scores):
+                if not norm_name: continue
+                
+                # Extract Info
+                fname = row["file_name"] or ""
+                size = row["size"] or 0
+                
+                obj = {
+                    "msg_id": row["msg_id"],
+                    "score": score,
+                    "size": size,
+                    "fname": fname
+                }
+                
+                if norm_name not in library: library[norm_name] = []
+                library[norm_name].append(obj)
+                count += 1
+
+        # --- FUZZY MERGE (OPTIONAL) ---
+        clusters = []
+        if fuzzy:
+            await status.edit(f"🔗 **Clustering Near-Duplicates...**\nTitles: {len(library)}")
+            clusters = await asyncio.to_thread(find_fuzzy_clusters, list(library))
+            for members, _ in clusters:
+                keep = members[0]
+                for other in members[1:]: library[keep].extend(library.pop(other))
+        timer.mark("analyze")
 
         # --- ANALYSIS PHASE ---
         await status.edit("🤔 **Analyzing Duplicates...**\nSelecting Best Quality...")
@@ -268,11 +1369,25 @@ async def scan_dupes_cmd(c, m):
         dupe_groups = 0
         safe_files = 0
         
+        # SORT LOGIC: Priority High Score -> High Size
+        for entries in library.values(): entries.sort(key=lambda x: (x['score'], x['size']), reverse=True)
+        
+        # The snapshot only drops deleted messages on its full rescan: probe every copy about
+        # to be kept and re-pick the next best while a kept one turns out to be gone
+        pending = [entries for entries in library.values() if len(entries) > 1]
+        while pending and job_running():
+            deleted, verified = await find_deleted_ids(chat.id, [entries[0]['msg_id'] for entries in pending], status)
+            if not verified: return await status.edit("❌ Could not verify the copies to keep. No plan created, retry later.")
+            if not deleted: break
+            INDEX_STORE.snapshot_delete(chat.id, deleted)
+            repicked = [entries for entries in pending if entries[0]['msg_id'] in deleted]
+            for entries in repicked: entries.pop(0)
+            pending = [entries for entries in repicked if len(entries) > 1]
+        if not job_running(): return await status.edit("⏹️ Stopped before the scan finished. No plan created.")
+        timer.mark("verify")
+        
         for title, entries in library.items():
             if len(entries) > 1:
-                # SORT LOGIC: Priority High Score -> High Size
-                entries.sort(key=lambda x: (x['score'], x['size']), reverse=True)
-                
                 # Best file is index 0. Rest are duplicates.
                 # Check condition: Only delete if the best file is actually "Good" or "Neutral"
                 # (Simple Logic: Just keep top 1, remove others)
@@ -286,42 +1401,47 @@ async def scan_dupes_cmd(c, m):
                 safe_files += 1
 
         # --- REPORTING (DRY RUN) ---
-        PENDING_STATE = {
-            "action": "delete_dupes",
-            "data": to_delete_ids,
-            "meta": {"chat_id": chat.id, "chat_title": chat.title},
-            "timestamp": time.time()
-        }
+        plan_id = PLANS.write("delete_dupes", {"chat_id": chat.id, "chat_title": chat.title}, to_delete_ids)["id"]
+        timer.mark("plan")
         
         report = (
             f"📊 **Smart Duplicate Scan Report**\n\n"
             f"📂 Total Scanned: `{count}`\n"
             f"🎬 Unique Movies: `{len(library)}`\n"
             f"👯 Duplicates Found: `{len(to_delete_ids)}` (in `{dupe_groups}` groups)\n\n"
+        )
+        if fuzzy:
+            report += f"🔗 **Fuzzy Clusters:** `{len(clusters)}`\n"
+            for members, sim in sorted(clusters, key=lambda x: x[1])[:10]:
+                report += f"• `{round(sim, 2)}` " + " | ".join(members[:3]) + ("…" if len(members) > 3 else "") + "\n"
+            report += "\n"
+        if not to_delete_ids: report += "✅ **Nothing to do:** no duplicates to delete."
+        else: report += (
             f"**Action Required:**\n"
             f"If you confirm, `{len(to_delete_ids)}` lower quality/duplicate files will be DELETED.\n"
             f"The BEST quality for each movie will be KEPT.\n\n"
-            f"⚠️ **Type `/confirm_clean` to execute or `/cancel_clean` to discard.**"
+            f"⚠️ **Type `/confirm_clean {plan_id}` to execute or `/cancel_clean {plan_id}` to discard.**"
         )
         await status.edit(report)
+        timer.mark("report")
+        timer.done()
         
     except Exception as e:
         await status.edit(f"❌ Error: {e}")
-        GLOBAL_TASK_RUNNING = False
 
 # --- 2. EDIT METADATA (USERNAME/LINK REMOVER) ---
 @app.on_message(filters.command("edit_metadata") & filters.create(only_admin))
+@job_command("edit_scan", chat_keys)
 async def edit_meta_cmd(c, m):
-    global PENDING_STATE, GLOBAL_TASK_RUNNING
     if len(m.command) < 2: return await m.reply("Usage: `/edit_metadata @channel`")
     
     chat_ref = m.command[1]
-    status = await m.reply(f"📝 **Scanning for Text Replacement in {chat_ref}...**")
-    GLOBAL_TASK_RUNNING = True
+    status = ProgressReporter(await m.reply(f"📝 **Scanning for Text Replacement in {chat_ref}...**"))
+    plan = None
     
     try:
-        chat = await c.get_chat(chat_ref)
-        edit_tasks = [] # List of {"msg_id": 123, "new_caption": "..."}
+        chat = await resolve_chat_id(c, chat_ref)
+        plan = PLANS.create("edit_metadata", {"chat_id": chat.id}) # Streams {"msg_id": 123, "new_caption": "..."} to disk
         
         count = 0
         matched = 0
@@ -331,11 +1451,13 @@ async def edit_meta_cmd(c, m):
         replace_text = EDIT_CONFIG.get("replace_with", "")
         lock_pattern = re.compile(EDIT_CONFIG.get("lock_regex", r"DO_NOT_MATCH_ANYTHING"))
         
-        async for msg in c.get_chat_history(chat.id):
-            if not GLOBAL_TASK_RUNNING: break
-            if not msg.caption: continue
+        timer = PhaseTimer("edit_metadata")
+        await refresh_snapshot(c, chat.id, status)
+        timer.mark("fetch")
+        for row in INDEX_STORE.snapshot_rows(chat.id, with_caption=True):
+            if not job_running(): break
             
-            original_cap = msg.caption
+            original_cap = row["caption"]
             
             # 🔒 LOCK CHECK
             if lock_pattern.search(original_cap):
@@ -361,44 +1483,39 @@ async def edit_meta_cmd(c, m):
                 changes_made = True
             
             if changes_made and new_cap != original_cap:
-                edit_tasks.append({"msg_id": msg.id, "new_caption": new_cap})
+                plan.add({"msg_id": row["msg_id"], "old_caption": original_cap, "new_caption": new_cap})
                 matched += 1
             
             count += 1
-            if count % 500 == 0:
-                try: await status.edit(f"📝 **Scanning...**\nChecked: {count}\nMatches: {matched}")
-                except: pass
                 
         # --- REPORTING ---
-        PENDING_STATE = {
-            "action": "edit_metadata",
-            "data": edit_tasks,
-            "meta": {"chat_id": chat.id},
-            "timestamp": time.time()
-        }
+        plan_id = plan.close()["id"]
+        timer.mark("plan")
+        timer.done()
         
         await status.edit(
             f"✅ **Edit Scan Complete!**\n\n"
             f"total Msgs: `{count}`\n"
-            f"To Be Edited: `{len(edit_tasks)}`\n"
-            f"Config: Remove `{len(remove_keywords)}` keys\n\n"
-            f"⚠️ **Type `/confirm_clean` to start editing.**"
+            f"To Be Edited: `{plan.count}`\n"
+            f"Config: Remove `{len(remove_keywords)}` keys\n\n" +
+            (f"⚠️ **Type `/confirm_clean {plan_id}` to start editing.**" if plan.count else "✅ **Nothing to do:** no captions need editing.")
         )
         
     except Exception as e:
+        if plan: plan.discard()
         await status.edit(f"❌ Error: {e}")
-        GLOBAL_TASK_RUNNING = False
 
 # --- 3. MONGODB SYNC (ORPHAN CLEANER) ---
 @app.on_message(filters.command("sync_library_with_db") & filters.create(only_admin))
+@job_command("sync_db", chat_keys)
 async def sync_db_cmd(c, m):
-    global PENDING_STATE
     if not DB_AVAILABLE: return await m.reply("❌ `database.py` missing or invalid.")
     if not DATABASE_URL: return await m.reply("❌ `DATABASE_URL` env variable missing.")
-    if len(m.command) < 2: return await m.reply("Usage: `/sync_library_with_db @channel`")
+    if len(m.command) < 2: return await m.reply("Usage: `/sync_library_with_db @channel [probe|scan]`")
 
     chat_ref = m.command[1]
-    status = await m.reply("🔄 **Connecting to External Database...**")
+    forced = m.command[2].lower() if len(m.command) > 2 and m.command[2].lower() in ("probe", "scan") else None
+    status = ProgressReporter(await m.reply("🔄 **Connecting to External Database...**"))
     
     db = Database(DATABASE_URL)
     
@@ -406,52 +1523,67 @@ async def sync_db_cmd(c, m):
         # 1. Connect
         if not await db.init_db():
             return await status.edit("❌ Failed to connect to MongoDB.")
-        
-        # 2. Fetch All DB Movies (Using method from your provided file)
-        await status.edit("📥 **Fetching MongoDB Data (Truth 1)...**")
-        db_movies = await db.get_all_movies_for_neon_sync() # Returns list of dicts
-        if not db_movies:
-            return await status.edit("❌ Database is empty or read failed.")
-            
-        db_map = {m['message_id']: m for m in db_movies if m.get('message_id')}
-        
-        # 3. Fetch Channel Data (Truth 2)
-        await status.edit("📡 **Scanning Channel (Truth 2)...**\nThis validates what actually exists.")
-        chat = await c.get_chat(chat_ref)
-        real_msg_ids = set()
-        
-        count = 0
-        async for msg in c.get_chat_history(chat.id):
-            real_msg_ids.add(msg.id)
-            count += 1
-            if count % 2000 == 0:
-                try: await status.edit(f"📡 **Scanning Channel...**\nFound: {count}")
-                except: pass
-                
-        # 4. Compare (Orphan Detection)
-        # Orphan = Exists in DB BUT NOT in Channel
-        orphan_ids = []
-        for msg_id, data in db_map.items():
+        chat = await resolve_chat_id(c, chat_ref)
+        col = mongo_collection(db)
+
+        # 2. Fetch DB refs for this channel (Truth 1): {message_id: id used for deletion}
+        await status.edit("📥 **Reading MongoDB Data (Truth 1)...**")
+        if col is not None:
+            # Bulk path: stream only this channel's refs, orphans are kept as message_ids
+            refs = await load_channel_refs(col, chat.id)
+        else:
+            # Legacy path: whole collection through the provided method
+            db_movies = await db.get_all_movies_for_neon_sync() # Returns list of dicts
+            if not db_movies:
+                return await status.edit("❌ Database is empty or read failed.")
             # Check if channel matches (to be safe)
-            if data.get('channel_id') == chat.id:
-                if msg_id not in real_msg_ids:
-                    orphan_ids.append(data['imdb_id']) # Or whichever ID method needed to delete
+            refs = {m['message_id']: m['imdb_id'] for m in db_movies if m.get('message_id') and m.get('channel_id') == chat.id}
+
+        # 3. Validate against the channel (Truth 2) with whichever strategy needs fewer calls:
+        #    probe = get_messages on the DB's own ids, scan = refresh the channel snapshot
+        newest = 0
+        async for msg in c.get_chat_history(chat.id, limit=1): newest = msg.id
+        probe_cost = math.ceil(len(refs) / INDEX_CONFIG["probe_batch"])
+        scan_cost = snapshot_refresh_cost(chat.id, newest, max_age=0)
+        strategy = forced or ("probe" if probe_cost < scan_cost else "scan")
+        await status.edit(
+            f"📡 **Validating against Channel (Truth 2)...**\n"
+            f"Strategy: `{strategy}` (probe ≈ {probe_cost} calls, scan ≈ {scan_cost} calls)"
+        )
+        if strategy == "probe":
+            missing, complete = await find_deleted_ids(chat.id, refs, status)
+            checked = f"🔎 Probed IDs: `{len(refs)}`" + ("" if complete else " _(some batches failed)_")
+        else:
+            # Fetch everything posted since the last refresh, or new posts would look like orphans
+            _, complete = await refresh_snapshot(c, chat.id, status, max_age=0)
+            if not complete: # Unfetched ranges would turn every DB ref in them into an "orphan"
+                await db.close()
+                return await status.edit("❌ Channel scan incomplete (failed ranges or stopped). No plan created, retry later.")
+            real_msg_ids = INDEX_STORE.snapshot_ids(chat.id)
+            top_id = (INDEX_STORE.snapshot_meta(chat.id) or {}).get("top_id", 0)
+            # Ids above the snapshot's top were posted after it: present, not orphans
+            missing = [msg_id for msg_id in refs if msg_id <= top_id and msg_id not in real_msg_ids]
+            checked = f"📺 Channel Files: `{len(real_msg_ids)}`"
+                
+        # A stopped scan has not seen the whole channel: its "missing" ids are not orphans
+        if not job_running():
+            await db.close()
+            return await status.edit("⏹️ Stopped before validation finished. No plan created.")
+
+        # 4. Orphan = Exists in DB BUT NOT in Channel
+        orphan_ids = [refs[msg_id] for msg_id in missing]
         
         # --- REPORTING ---
-        PENDING_STATE = {
-            "action": "sync_db",
-            "data": orphan_ids, # List of IMDB IDs or File IDs to remove from DB
-            "meta": {"db_conn": db}, # Holding connection ref (risky but needed)
-            "timestamp": time.time()
-        }
+        # message_ids (bulk) or IMDB IDs (legacy) to remove from DB
+        plan_id = PLANS.write("sync_db", {"channel_id": chat.id, "bulk": col is not None}, orphan_ids)["id"]
         
         await status.edit(
             f"⚖️ **Sync Report Generated**\n\n"
-            f"📚 DB Entries: `{len(db_map)}`\n"
-            f"📺 Channel Files: `{len(real_msg_ids)}`\n"
+            f"📚 DB Entries (this channel): `{len(refs)}`\n"
+            f"{checked}\n"
             f"🗑️ **Orphans Found:** `{len(orphan_ids)}`\n"
-            f"_(Entries in DB but deleted from Channel)_\n\n"
-            f"⚠️ **Type `/confirm_clean` to DELETE these from MongoDB.**"
+            f"_(Entries in DB but deleted from Channel)_\n\n" +
+            (f"⚠️ **Type `/confirm_clean {plan_id}` to DELETE these from MongoDB.**" if orphan_ids else "✅ **Nothing to do:** DB is in sync.")
         )
         
         # Note: Connection left open for confirm, or needs reconnect. 
@@ -465,89 +1597,132 @@ async def sync_db_cmd(c, m):
 
 # --- 4. EXECUTION HANDLERS (CONFIRM / CANCEL) ---
 
+async def execute_channel_action(action, data, chat_id):
+    """Runs a delete/edit plan on all sessions. Returns (done, dead)."""
+    if action == "delete_dupes":
+        return await run_work_queue(
+            data, lambda cl, batch, name: parallel_delete_worker(cl, batch, chat_id, name), batch_size=100, job=action, chats=[chat_id],
+        window=PIPELINE_CONFIG["delete"])
+    return await run_work_queue(
+        data, lambda cl, batch, name: parallel_edit_worker(cl, batch, chat_id, name), batch_size=EDIT_CONFIG["batch"],
+        job=action, chats=[chat_id],
+        window=PIPELINE_CONFIG["edit"])
+
 @app.on_message(filters.command("cancel_clean") & filters.create(only_admin))
 async def cancel_clean(c, m):
-    global PENDING_STATE
-    PENDING_STATE = {"action": None, "data": [], "meta": {}, "timestamp": 0}
-    await m.reply("✅ Pending action cancelled. State cleared.")
+    """`/cancel_clean [plan_id]` deletes one plan, or every plan without an id. Plans a job is running are kept."""
+    if len(m.command) > 1 and m.command[1].isdigit():
+        plan_id = int(m.command[1])
+        busy = JOBS.conflict([("plan", plan_id)])
+        if busy: return await m.reply(f"❌ Plan `#{plan_id}` is in use by job `#{busy.id}`. `/stop {busy.id}` first.")
+        if not PLANS.delete(plan_id): return await m.reply("❌ No such plan. See `/jobs`.")
+        return await m.reply(f"✅ Plan `#{plan_id}` cancelled.")
+    kept = [plan_id for plan_id in PLANS.ids() if JOBS.conflict([("plan", plan_id)])]
+    for plan_id in PLANS.ids():
+        if plan_id not in kept: PLANS.delete(plan_id)
+    note = f"\n⏳ Kept (running): {', '.join(f'`#{i}`' for i in kept)}" if kept else ""
+    await m.reply("✅ Pending actions cancelled. Plans cleared." + note)
 
 @app.on_message(filters.command("confirm_clean") & filters.create(only_admin))
 async def confirm_clean(c, m):
-    global PENDING_STATE, GLOBAL_TASK_RUNNING
-    
-    action = PENDING_STATE.get("action")
-    data = PENDING_STATE.get("data")
-    meta = PENDING_STATE.get("meta")
-    
-    if not action or not data:
+    """
+    `/confirm_clean [plan_id] [limit]` runs a stored plan (the newest unfinished one without
+    an id) from where it stopped last time; `limit` executes only that many more items.
+    """
+    args = [int(a) for a in m.command[1:] if a.isdigit()]
+    plan_id = args[0] if args else PLANS.latest()
+    limit = args[1] if len(args) > 1 else None
+    info = PLANS.info(plan_id) if plan_id else None
+    if not info or info["done"] >= info["count"]:
         return await m.reply("❌ No pending action. Run a scan command first.")
     
-    # Timeout check (10 mins)
-    if time.time() - PENDING_STATE.get("timestamp", 0) > 600:
-        return await m.reply("❌ Confirmation timed out. Rescan required.")
-    
-    GLOBAL_TASK_RUNNING = True
-    status = await m.reply(f"🚀 **Executing {action.upper()}...**\nItems: {len(data)}\nMode: 5-Core Parallel")
-    
-    try:
-        # A. DELETE DUPES EXECUTION
-        if action == "delete_dupes":
-            active_clients = [cl for cl in ALL_CLIENTS if cl.is_connected]
-            # Split data
-            chunk_size = math.ceil(len(data) / len(active_clients))
-            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
-            
-            tasks = []
-            for i, client in enumerate(active_clients):
-                if i < len(chunks):
-                    tasks.append(parallel_delete_worker(client, chunks[i], meta['chat_id'], f"Session-{i+1}"))
-            
-            results = await asyncio.gather(*tasks)
-            total_deleted = sum(results)
-            await status.edit(f"✅ **Cleanup Complete!**\n🗑️ Deleted Messages: `{total_deleted}`")
+    # Age check: a week-old plan no longer describes the channel
+    if time.time() - info["created"] > PLAN_CONFIG["max_age"]:
+        return await m.reply(f"❌ Plan `#{plan_id}` is too old. Rescan required.")
 
-        # B. EDIT METADATA EXECUTION
-        elif action == "edit_metadata":
-            active_clients = [cl for cl in ALL_CLIENTS if cl.is_connected]
-            chunk_size = math.ceil(len(data) / len(active_clients))
-            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
-            
-            tasks = []
-            for i, client in enumerate(active_clients):
-                if i < len(chunks):
-                    tasks.append(parallel_edit_worker(client, chunks[i], meta['chat_id'], f"Session-{i+1}"))
-            
-            results = await asyncio.gather(*tasks)
-            total_edited = sum(results)
-            await status.edit(f"✅ **Editing Complete!**\n📝 Messages Updated: `{total_edited}`")
+    meta = info["meta"]
+    target = meta.get("chat_id", meta.get("channel_id"))
+    return await start_job(m, "confirm", lambda: run_plan(m, plan_id, limit), [("plan", plan_id), ("chat", target)])
+
+async def execute_plan_chunk(action, meta, chunk, db=None):
+    """Executes one chunk of a plan. Returns (done, dead_count)."""
+    if action in ("delete_dupes", "edit_metadata"):
+        done, dead = await execute_channel_action(action, chunk, meta['chat_id'])
+        DEAD_LETTERS.add(action, {"chat_id": meta['chat_id']}, dead)
+        return done, len(dead)
+    # sync_db: message_ids (bulk) or IMDB IDs (legacy) to remove from MongoDB
+    col = mongo_collection(db) if meta.get("bulk") else None
+    if col is not None: return await bulk_delete_orphans(col, meta["channel_id"], chunk), 0
+    deleted_count = 0
+    for imdb_id in chunk:
+        if not job_running(): break
+        await db.remove_movie_by_imdb(imdb_id)
+        deleted_count += 1
+    return deleted_count, 0
 
-        # C. DB SYNC EXECUTION
-        elif action == "sync_db":
+async def run_plan(m, plan_id, limit=None):
+    info = PLANS.info(plan_id)
+    action, meta = info["action"], info["meta"]
+    start = info["done"]
+    end = min(info["count"], start + limit) if limit else info["count"]
+    status = ProgressReporter(await m.reply(
+        f"🚀 **Executing {action.upper()}** (plan `#{plan_id}`)...\nItems: {start}-{end} of {info['count']}\nMode: 5-Core Parallel"))
+    timer = PhaseTimer(f"confirm_{action}")
+    done_total = dead_total = 0
+    db = None
+    
+    try:
+        if not await asyncio.to_thread(PLANS.verify, info):
+            return await status.edit(f"❌ Plan `#{plan_id}` failed its checksum. Rescan required.")
+        if action == "sync_db":
             # This is DB operation, single threaded is fine, but we need to reconnect
             db = Database(DATABASE_URL)
             await db.init_db()
-            
-            deleted_count = 0
-            # Batch delete from DB
-            for imdb_id in data:
-                if not GLOBAL_TASK_RUNNING: break
-                # Assuming DB has remove_movie_by_imdb or similar
-                # Using the existing method from your file
-                await db.remove_movie_by_imdb(imdb_id) 
-                deleted_count += 1
-                if deleted_count % 100 == 0:
-                    try: await status.edit(f"🗑️ **Deleting from DB...**\n{deleted_count}/{len(data)}")
-                    except: pass
-            
-            await db.close()
-            await status.edit(f"✅ **Sync Complete!**\n🗑️ Removed from DB: `{deleted_count}`")
 
+        # Streamed from disk chunk by chunk; `done` only moves past fully executed chunks,
+        # so a stop repeats at most one chunk (deletes/edits of handled items are no-ops)
+        for chunk in PLANS.chunks(plan_id, start, end - start):
+            done, dead = await execute_plan_chunk(action, meta, chunk, db)
+            done_total += done
+            dead_total += dead
+            if not job_running(): break
+            info["done"] += len(chunk)
+            PLANS.save_info(info)
+            status.update(f"🚀 **Executing {action.upper()}** (plan `#{plan_id}`)\nProgress: {info['done']}/{info['count']}")
+
+        failed_note = f"\n☠️ Dead-lettered: `{dead_total}` (`/dead_letters`)" if dead_total else ""
+        if info["done"] < info["count"]:
+            failed_note += f"\n⏸️ Plan `#{plan_id}` at `{info['done']}/{info['count']}`: `/confirm_clean {plan_id}` continues."
+        else: PLANS.delete(plan_id)
+        if action == "delete_dupes":
+            await status.edit(f"✅ **Cleanup Complete!**\n🗑️ Deleted Messages: `{done_total}`{failed_note}")
+        elif action == "edit_metadata":
+            await status.edit(f"✅ **Editing Complete!**\n📝 Messages Updated: `{done_total}`{failed_note}")
+        else:
+            await status.edit(f"✅ **Sync Complete!**\n🗑️ Removed from DB: `{done_total}`{failed_note}")
+
+    except ChatUnreachable as e:
+        await status.edit(f"⏸️ {e}.\nPlan `#{plan_id}` kept at `{info['done']}/{info['count']}`: `/confirm_clean {plan_id}` retries.")
     except Exception as e:
         await status.edit(f"❌ Execution Failed: {e}")
     finally:
-        # Reset State
-        PENDING_STATE = {"action": None, "data": [], "meta": {}, "timestamp": 0}
-        GLOBAL_TASK_RUNNING = False
+        if db:
+            try: await db.close()
+            except: pass
+        timer.mark("execute")
+        timer.done()
+        RATE_LIMITER.save()
+
+@app.on_message(filters.command("export_plan") & filters.create(only_admin))
+async def export_plan_cmd(_, m):
+    """`/export_plan [plan_id]` sends the plan file (gzip JSONL, header line first) to the chat."""
+    plan_id = int(m.command[1]) if len(m.command) > 1 and m.command[1].isdigit() else PLANS.latest()
+    info = PLANS.info(plan_id) if plan_id else None
+    if not info: return await m.reply("❌ No such plan. See `/jobs`.")
+    await m.reply_document(PLANS.body(plan_id), caption=(
+        f"📦 Plan `#{plan_id}` {info['action']}: {info['count']} items ({info['done']} done)\n"
+        f"sha256 `{info['sha256']}`"
+    ))
 
 # ==============================================================================
 # 🧩 EXISTING UTILS (Must Remain)
@@ -572,7 +1747,7 @@ def get_media_details(m):
                 return None, 0, None
     return getattr(media, 'file_name', "Unknown"), getattr(media, 'file_size', 0), getattr(media, 'file_unique_id', None)
 
-async def resolve_chat_id(client, ref):
+async def fetch_chat(client, ref):
     ref_str = str(ref).strip()
     try:
         if ref_str.lstrip('-').isdigit(): return await client.get_chat(int(ref_str))
@@ -582,148 +1757,1222 @@ async def resolve_chat_id(client, ref):
         except UserAlreadyParticipant: pass
     return await client.get_chat(ref_str)
 
+async def resolve_chat_id(client, ref):
+    return await PEERS.resolve(client, ref)
+
+# --- PEER / CHAT CACHE (SHARED BY ALL SESSIONS) ---
+
+def peer_row(chat_id, peer):
+    """InputPeer -> [id, access_hash, type, username, phone_number] as storage.update_peers takes it."""
+    if isinstance(peer, raw.types.InputPeerChannel): return [chat_id, peer.access_hash, "channel", None, None]
+    if isinstance(peer, raw.types.InputPeerUser): return [chat_id, peer.access_hash, "user", None, None]
+    if isinstance(peer, raw.types.InputPeerChat): return [chat_id, 0, "group", None, None]
+    return None
+
+class PeerCache:
+    """
+    Sessions run in_memory, so each one boots with an empty peer table and a bare chat
+    id raises PeerIdInvalid on any session that never resolved it. One JSON file keeps
+      chats: ref -> {"id", "title", "username", "ts"}, reused for PEER_CONFIG["chat_ttl"]
+      peers: account id -> {chat id: peer row} (access hashes are per account)
+    restore() refills a session's storage after every (re)start; warm() makes a session
+    resolve a job's chats before it leases work, by id, by username or by a dialog walk.
+    """
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.chats = {}
+        self.peers = {}
+        self.ready = {} # session name -> chat ids it can address right now
+        self.locks = {} # session name -> lock, so parallel lanes of a session warm once
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f: data = json.load(f)
+                self.chats, self.peers = data.get("chats", {}), data.get("peers", {})
+            except: pass
+
+    def save(self):
+        if not self.dirty: return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f: json.dump({"chats": self.chats, "peers": self.peers}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def account(self, client):
+        me = getattr(client, "me", None)
+        return str(me.id) if me else None
+
+    async def restore(self, client):
+        self.ready.pop(client.name, None)
+        rows = self.peers.get(self.account(client))
+        if rows and getattr(client, "storage", None): await client.storage.update_peers([tuple(r) for r in rows.values()])
+
+    async def remember(self, client, chat_id):
+        self.ready.setdefault(client.name, set()).add(chat_id)
+        key = self.account(client)
+        if not key or not getattr(client, "storage", None): return
+        try: row = peer_row(chat_id, await client.storage.get_peer_by_id(chat_id))
+        except KeyError: return
+        if row and self.peers.setdefault(key, {}).get(str(chat_id)) != row:
+            self.peers[key][str(chat_id)] = row
+            self.dirty = True
+
+    async def reachable(self, client, chat_id):
+        if chat_id in self.ready.get(client.name, ()): return True
+        try: await client.resolve_peer(chat_id)
+        except FloodWait as e:
+            POOL.flood(client, e.value)
+            return False
+        except Exception: return False
+        await self.remember(client, chat_id)
+        return True
+
+    async def warm(self, client, chat_ids):
+        """True once this session can address every chat in chat_ids."""
+        ready = self.ready.get(client.name, ())
+        if all(chat_id in ready for chat_id in chat_ids): return True
+        async with self.locks.setdefault(client.name, asyncio.Lock()):
+            return await self._warm(client, chat_ids)
+
+    async def _warm(self, client, chat_ids):
+        missing = [chat_id for chat_id in dict.fromkeys(chat_ids) if not await self.reachable(client, chat_id)]
+        if missing:
+            usernames = {c["id"]: c["username"] for c in self.chats.values() if c.get("username")}
+            for chat_id in [c for c in missing if c in usernames]:
+                try: await client.get_chat(usernames[chat_id])
+                except Exception: continue
+                if await self.reachable(client, chat_id): missing.remove(chat_id)
+        if missing:
+            # Private chats: listing dialogs stores the access hash of every chat the account is in
+            try:
+                async for d in client.get_dialogs(limit=self.config["dialog_scan"]):
+                    if d.chat.id in missing and await self.reachable(client, d.chat.id): missing.remove(d.chat.id)
+                    if not missing: break
+            except Exception as e: print(f"[{client.name}] Dialog scan failed: {e}")
+        self.save()
+        METRICS.inc("bot_peer_warm_total", session=client.name, result="failed" if missing else "ok")
+        return not missing
+
+    async def resolve(self, client, ref):
+        """Cached fetch_chat: a fresh entry is reused as long as this session can reach the chat."""
+        key = str(ref).strip()
+        hit = self.chats.get(key)
+        if hit and time.time() - hit["ts"] < self.config["chat_ttl"] and await self.reachable(client, hit["id"]):
+            METRICS.inc("bot_peer_cache_total", result="hit")
+            return SimpleNamespace(**hit)
+        METRICS.inc("bot_peer_cache_total", result="miss")
+        chat = await fetch_chat(client, key)
+        entry = {"id": chat.id, "title": getattr(chat, "title", None), "username": getattr(chat, "username", None), "ts": time.time()}
+        self.chats[key] = self.chats[str(chat.id)] = entry
+        self.dirty = True
+        await self.remember(client, chat.id)
+        self.save()
+        return chat
+
+PEERS = PeerCache(DB_FILES["peers"], PEER_CONFIG)
+
+# --- COMPACT KEY SETS (TARGET CACHE) ---
+
+class HashSet64:
+    """
+    Set of 64-bit key hashes: a sorted uint64 array (memory-mapped when loaded from
+    disk) plus a small Python set for keys added since. ~8 bytes per key instead of
+    ~100 for a str in a set. A hash collision (odds ~n²/2⁶⁵) reads as "present".
+    File: header (magic, count) + native-endian uint64 array.
+    """
+    MAGIC = b"HSET64v1"
+    HEADER = struct.Struct("<8sQ")
+
+    def __init__(self):
+        self.base = array("Q")
+        self.delta = set()
+        self.mm = None
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "little")
+
+    def add(self, key): self.delta.add(self.hash(key))
+
+    def __contains__(self, key):
+        h = self.hash(key)
+        if h in self.delta: return True
+        i = bisect_left(self.base, h)
+        return i < len(self.base) and self.base[i] == h
+
+    def __len__(self): return len(self.base) + len(self.delta)
+
+    def build(self, hashes):
+        """Replaces the contents with an array of key hashes, sorted in bounded runs then merged."""
+        self.close()
+        run = 1 << 18
+        runs = [array("Q", sorted(hashes[i:i + run])) for i in range(0, len(hashes), run)]
+        self.base = array("Q", (h for h, _ in groupby(merge(*runs))))
+        self.delta = set()
+
+    def save(self, path):
+        """Merges delta into the sorted array and writes it atomically."""
+        merged = array("Q", (h for h, _ in groupby(merge(self.base, sorted(self.delta)))))
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(merged)))
+            merged.tofile(f)
+        os.replace(tmp, path)
+        self.close()
+        self.base = merged
+        self.delta = set()
+
+    def load(self, path):
+        self.close()
+        with open(path, "rb") as f:
+            magic, count = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC: raise ValueError(f"{path}: not a HashSet64 file")
+            if count: self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base = memoryview(self.mm)[self.HEADER.size:self.HEADER.size + 8 * count].cast("Q") if count else array("Q")
+        self.delta = set()
+
+    def close(self):
+        if isinstance(self.base, memoryview): self.base.release()
+        if self.mm: self.mm.close()
+        self.base, self.mm = array("Q"), None
+
+def target_cache_paths():
+    base = DB_FILES["target_cache"].rsplit(".", 1)[0]
+    return f"{base}.uids.hset", f"{base}.names.hset"
+
+def file_signature(path):
+    if not os.path.exists(path): return None
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+def save_target_cache(db_file):
+    uids_path, names_path = target_cache_paths()
+    target_cache["unique_ids"].save(uids_path)
+    target_cache["name_size"].save(names_path)
+    history = DB_FILES["history"]
+    meta = {"db_file": db_file, "index_sig": file_signature(db_file),
+            "history_sig": file_signature(history), "history_bytes": os.path.getsize(history) if os.path.exists(history) else 0}
+    with open(DB_FILES["target_cache"], "w") as f: json.dump(meta, f)
+
 def load_target_cache(db_file):
+    """
+    Fills target_cache from history + the target index. The result is kept as two
+    mmap-able HashSet64 files: while the target index is unchanged they are mapped
+    as-is and only history lines appended since are read.
+    """
     global target_cache
-    target_cache["unique_ids"].clear()
-    target_cache["name_size"].clear()
-    if os.path.exists(DB_FILES["history"]):
-        with open(DB_FILES["history"], "r") as f:
-            for line in f: target_cache["unique_ids"].add(line.strip())
-    if os.path.exists(db_file):
+    HISTORY.flush()
+    for key in ("unique_ids", "name_size"):
+        if isinstance(target_cache[key], HashSet64): target_cache[key].close()
+        target_cache[key] = HashSet64()
+    history = DB_FILES["history"]
+    uids_path, names_path = target_cache_paths()
+    try:
+        with open(DB_FILES["target_cache"], "r") as f: meta = json.load(f)
+    except (OSError, ValueError): meta = {}
+    hist_sig = file_signature(history)
+    reusable = (meta.get("db_file") == db_file and meta.get("index_sig") == file_signature(db_file)
+                and hist_sig and meta.get("history_sig") and meta["history_sig"][0] == hist_sig[0]
+                and meta.get("history_bytes", 0) <= hist_sig[1]
+                and os.path.exists(uids_path) and os.path.exists(names_path))
+    if reusable:
         try:
-            with open(db_file, "r") as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    target_cache["unique_ids"].update(data.get("unique_ids", []))
-                    target_cache["name_size"].update(data.get("compound_keys", []))
-        except: pass
+            target_cache["unique_ids"].load(uids_path)
+            target_cache["name_size"].load(names_path)
+            with open(history, "r") as f:
+                f.seek(meta["history_bytes"])
+                for line in f:
+                    if line.strip(): target_cache["unique_ids"].add(line.strip())
+            if len(target_cache["unique_ids"].delta) >= INDEX_CONFIG["cache_merge_every"]: save_target_cache(db_file)
+            return
+        except Exception as e: print(f"Target cache load failed, rebuilding: {e}")
+
+    h = HashSet64.hash
+    uids, names = array("Q"), array("Q")
+    try:
+        if os.path.exists(history):
+            with open(history, "r") as f:
+                for line in f:
+                    if line.strip(): uids.append(h(line.strip()))
+        if os.path.exists(db_file):
+            for rec in iter_index(db_file):
+                if rec.get("unique_id"): uids.append(h(rec["unique_id"]))
+                if rec.get("name") and rec.get("size"): names.append(h(f"{rec['name']}-{rec['size']}"))
+        target_cache["unique_ids"].build(uids)
+        target_cache["name_size"].build(names)
+        save_target_cache(db_file)
+    except Exception as e: print(f"Target index read failed: {e}")
+
+class HistoryJournal:
+    """
+    Buffered writer for history_ids.txt. Appends collect in memory and a background
+    task writes + fsyncs them every HISTORY_CONFIG["flush_interval"] seconds; flush()
+    does it at once (job end, before the forward journal records progress).
+    maybe_compact() rewrites the file as a deduplicated snapshot once enough lines
+    were appended; it runs between jobs because it replaces the file.
+    """
+    def __init__(self, path, config):
+        self.path = path
+        self.meta_path = path + ".meta" # {"compacted_bytes": file size right after the last compaction}
+        self.config = config
+        self.buffer = []
+        self.task = None
+        try:
+            with open(self.meta_path, "r") as f: compacted = json.load(f)["compacted_bytes"]
+        except (OSError, ValueError, KeyError): compacted = 0
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.appended = max(0, size - compacted) # Bytes written since the last compaction
+
+    def append(self, unique_id):
+        self.buffer.append(unique_id)
+        if self.task is None or self.task.done():
+            try: self.task = asyncio.get_running_loop().create_task(self._writer())
+            except RuntimeError: self.flush()
+
+    async def _writer(self):
+        while self.buffer:
+            await asyncio.sleep(self.config["flush_interval"])
+            self.flush()
+
+    def flush(self):
+        if not self.buffer: return
+        data, self.buffer = "\n".join(self.buffer) + "\n", []
+        with open(self.path, "a") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.appended += len(data)
+
+    def maybe_compact(self, force=False):
+        """Returns (lines_before, lines_after) if the file was compacted, else None."""
+        self.flush()
+        if not os.path.exists(self.path): return None
+        if not force and self.appended < self.config["compact_bytes"]: return None
+        seen = set()
+        before = after = 0
+        tmp = self.path + ".tmp"
+        with open(self.path, "r") as src, open(tmp, "w") as dst:
+            for line in src:
+                uid = line.strip()
+                if not uid: continue
+                before += 1
+                h = HashSet64.hash(uid)
+                if h in seen: continue
+                seen.add(h)
+                dst.write(uid + "\n")
+                after += 1
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, self.path)
+        with open(self.meta_path, "w") as f: json.dump({"compacted_bytes": os.path.getsize(self.path)}, f)
+        self.appended = 0
+        return before, after
+
+HISTORY = HistoryJournal(DB_FILES["history"], HISTORY_CONFIG)
 
 def save_history(unique_id, name, size):
     if unique_id:
         target_cache["unique_ids"].add(unique_id)
-        with open(DB_FILES["history"], "a") as f: f.write(f"{unique_id}\n")
+        HISTORY.append(unique_id)
     if name and size: target_cache["name_size"].add(f"{name}-{size}")
 
-# --- OLD ENGINES (UNCHANGED) ---
+# --- STREAMING INDEX FILES (APPEND-ONLY JSONL) ---
+
+def open_index(path, mode="r"):
+    if path.endswith(".gz"): return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+class IndexWriter:
+    """Buffered appender: records hit the disk every `buffer_size` items, so a crash keeps partial work."""
+    def __init__(self, path, truncate=False, buffer_size=None):
+        self.path = path
+        self.buffer = []
+        self.buffer_size = buffer_size or INDEX_CONFIG["write_buffer"]
+        if truncate:
+            open_index(path, "w").close()
+            INDEX_STORE.drop(path) # Same inode after a rewrite: the store must not keep the old rows
+        elif path in TORN_INDEXES: compact_index(path) # Members appended after a torn one would be unreadable
+
+    def add(self, record):
+        self.buffer.append(json.dumps(record, separators=(",", ":")))
+        if len(self.buffer) >= self.buffer_size: self.flush()
+
+    def flush(self):
+        if not self.buffer: return
+        with open_index(self.path, "a") as f: f.write("\n".join(self.buffer) + "\n")
+        self.buffer = []
+
+    def close(self): self.flush()
+
+TORN_INDEXES = set() # Gzip indexes whose last member was cut off by a crash; compacted before the next append
+
+def iter_index(path):
+    """
+    Yields index records in file order, repeats included (re-scanned ranges): readers that
+    care dedupe themselves (the store's UNIQUE (db, msg_id), compact_index), so memory stays flat.
+    """
+    with open_index(path, "r") as f:
+        try:
+            for line in f:
+                try: yield json.loads(line)
+                except ValueError: continue # Torn last line after a crash
+        except (EOFError, gzip.BadGzipFile): # Crash mid-append: the last gzip member is cut off
+            print(f"⚠️ {path}: torn gzip member ignored, the file is compacted before the next append")
+            TORN_INDEXES.add(path)
+
+def compact_index(path, drop_ids=()):
+    """Rewrites an index without duplicates (first record of a msg_id wins) and without the given msg_ids."""
+    drop_ids = set(drop_ids)
+    seen = set()
+    root, ext = os.path.splitext(path)
+    tmp = root + ".tmp" + ext # Keeps the .gz suffix, so open_index writes the same format
+    writer = IndexWriter(tmp, truncate=True, buffer_size=5000)
+    kept = 0
+    for rec in iter_index(path):
+        msg_id = rec.get("msg_id")
+        if msg_id in drop_ids or msg_id in seen: continue
+        if msg_id is not None: seen.add(msg_id)
+        writer.add(rec)
+        kept += 1
+    writer.close()
+    os.replace(tmp, path)
+    TORN_INDEXES.discard(path)
+    return kept
+
+def migrate_legacy_indexes():
+    """Converts old monolithic db_*.json files to the JSONL format (once, at startup)."""
+    state = load_index_state()
+    for key in ("movie_source", "movie_target", "full_source", "full_target"):
+        new_path = DB_FILES[key]
+        old_path = new_path.split(".jsonl")[0] + ".json"
+        if not os.path.exists(old_path) or os.path.exists(new_path): continue
+        try:
+            with open(old_path, "r") as f: data = json.load(f)
+            writer = IndexWriter(new_path, truncate=True, buffer_size=5000)
+            if isinstance(data, dict): # Target format: unique_ids + "name-size" keys
+                for uid in data.get("unique_ids", []): writer.add({"unique_id": uid})
+                for key_str in data.get("compound_keys", []):
+                    name, _, size = key_str.rpartition("-")
+                    writer.add({"name": name, "size": int(size) if size.isdigit() else size})
+            else:
+                for rec in data: writer.add(rec)
+            writer.close()
+            os.replace(old_path, old_path + ".migrated")
+            if old_path in state: state[new_path] = state.pop(old_path)
+            print(f"📦 Migrated {old_path} -> {new_path}")
+        except Exception as e: print(f"Migration failed for {old_path}: {e}")
+    save_index_state(state)
+
+# --- SQLITE INDEX STORE (QUERYABLE MIRROR OF THE JSONL FILES) ---
+
+class IndexStore:
+    """
+    SQLite mirror of the index files and history_ids.txt with secondary indexes on
+    unique_id, (name, size) and (chat_id, msg_id). The files stay the source of truth;
+    sync_file() imports only the appended tail, or everything after a rewrite.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            db TEXT NOT NULL, msg_id INTEGER, chat_id INTEGER,
+            unique_id TEXT, name TEXT, size INTEGER,
+            UNIQUE (db, msg_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_items_uid ON items (db, unique_id);
+        CREATE INDEX IF NOT EXISTS idx_items_name_size ON items (db, name, size);
+        CREATE INDEX IF NOT EXISTS idx_items_chat_msg ON items (db, chat_id, msg_id);
+        CREATE TABLE IF NOT EXISTS history (unique_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS snapshot (
+            chat_id INTEGER NOT NULL, msg_id INTEGER NOT NULL, kind TEXT,
+            unique_id TEXT, file_name TEXT, size INTEGER, caption TEXT, mime TEXT, gen INTEGER,
+            PRIMARY KEY (chat_id, msg_id)
+        );
+    """
+    SNAPSHOT_COLUMNS = ("msg_id", "kind", "unique_id", "file_name", "size", "caption", "mime")
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def _get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _file_marker(self, path):
+        st = os.stat(path)
+        head_len = min(st.st_size, 4096)
+        return {"inode": st.st_ino, "size": st.st_size, "mtime": st.st_mtime, "head_len": head_len, "head": self._head(path, head_len)}
+
+    def _head(self, path, length):
+        with open(path, "rb") as f: return hashlib.sha1(f.read(length)).hexdigest()
+
+    def _append_offset(self, path, seen, marker):
+        """Size of the part already imported if the file only grew since `seen`, else 0 (full re-import)."""
+        if not seen or "head" not in seen or seen["inode"] != marker["inode"]: return 0
+        if marker["size"] < seen["size"] or marker["mtime"] < seen["mtime"]: return 0
+        # Truncated and rewritten in place keeps the inode and can outgrow the old size
+        if self._head(path, seen["head_len"]) != seen["head"]: return 0
+        return seen["size"]
+
+    def sync_file(self, path):
+        """Brings the items of one index file up to date with the file on disk."""
+        if not os.path.exists(path): return self.drop(path)
+        marker = self._file_marker(path)
+        seen = self._get_meta(f"file:{path}")
+        if seen == marker: return
+        offset = 0 if path.endswith(".gz") else self._append_offset(path, seen, marker)
+        with self.conn:
+            if not offset:
+                self.conn.execute("DELETE FROM items WHERE db = ?", (path,))
+                rows = iter_index(path)
+            else:
+                rows = self._read_tail(path, offset)
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO items (db, msg_id, chat_id, unique_id, name, size) VALUES (?, ?, ?, ?, ?, ?)",
+                ((path, r.get("msg_id"), r.get("chat_id"), r.get("unique_id"), r.get("name"), r.get("size")) for r in rows)
+            )
+            self._set_meta(f"file:{path}", marker)
+
+    def _read_tail(self, path, offset):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try: yield json.loads(line)
+                except ValueError: continue
+
+    def sync_history(self):
+        path = DB_FILES["history"]
+        if not os.path.exists(path): return
+        marker = self._file_marker(path)
+        seen = self._get_meta("file:history")
+        if seen == marker: return
+        offset = self._append_offset(path, seen, marker)
+        with self.conn, open(path, "r") as f:
+            if not offset: self.conn.execute("DELETE FROM history")
+            f.seek(offset)
+            self.conn.executemany("INSERT OR IGNORE INTO history (unique_id) VALUES (?)",
+                                  ((line.strip(),) for line in f if line.strip()))
+            self._set_meta("file:history", marker)
+
+    def drop(self, path):
+        with self.conn:
+            if path == DB_FILES["history"]:
+                self.conn.execute("DELETE FROM history")
+                self.conn.execute("DELETE FROM meta WHERE key = 'file:history'")
+            else:
+                self.conn.execute("DELETE FROM items WHERE db = ?", (path,))
+                self.conn.execute("DELETE FROM meta WHERE key = ?", (f"file:{path}",))
+
+    def pending_items(self, source_db, target_db, limit=None):
+        """Source items whose unique_id / (name, size) is neither in the target index nor in history."""
+        sql = """
+            SELECT s.msg_id, s.chat_id, s.unique_id, s.name, s.size FROM items s
+            WHERE s.db = ?
+              AND NOT EXISTS (SELECT 1 FROM items t WHERE t.db = ? AND t.unique_id = s.unique_id)
+              AND NOT EXISTS (SELECT 1 FROM items t WHERE t.db = ? AND t.name = s.name AND t.size = s.size)
+              AND NOT EXISTS (SELECT 1 FROM history h WHERE h.unique_id = s.unique_id)
+            ORDER BY s.chat_id, s.msg_id
+        """
+        params = [source_db, target_db, target_db]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        for row in self.conn.execute(sql, params):
+            yield dict(zip(("msg_id", "chat_id", "unique_id", "name", "size"), row))
+
+    # --- Channel snapshot (message metadata shared by all scanning commands) ---
+
+    def snapshot_meta(self, chat_id):
+        return self._get_meta(f"snap:{chat_id}")
+
+    def set_snapshot_meta(self, chat_id, meta):
+        with self.conn: self._set_meta(f"snap:{chat_id}", meta)
+
+    def snapshot_put(self, chat_id, gen, rows):
+        if not rows: return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO snapshot (chat_id, msg_id, kind, unique_id, file_name, size, caption, mime, gen) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [(chat_id, *row, gen) for row in rows])
+
+    def snapshot_prune(self, chat_id, gen):
+        """Drops rows a completed full scan did not see again (deleted messages)."""
+        with self.conn: self.conn.execute("DELETE FROM snapshot WHERE chat_id = ? AND gen < ?", (chat_id, gen))
+
+    def snapshot_delete(self, chat_id, msg_ids):
+        with self.conn: self.conn.executemany("DELETE FROM snapshot WHERE chat_id = ? AND msg_id = ?", [(chat_id, i) for i in msg_ids])
+
+    def snapshot_set_caption(self, chat_id, msg_id, caption):
+        with self.conn: self.conn.execute("UPDATE snapshot SET caption = ? WHERE chat_id = ? AND msg_id = ?", (caption, chat_id, msg_id))
+
+    def snapshot_rows(self, chat_id, media_only=False, with_caption=False, after_id=0):
+        """Yields snapshot rows newest first, like get_chat_history."""
+        sql = "SELECT msg_id, kind, unique_id, file_name, size, caption, mime FROM snapshot WHERE chat_id = ? AND msg_id > ?"
+        if media_only: sql += " AND kind IS NOT NULL"
+        if with_caption: sql += " AND caption IS NOT NULL AND caption != ''"
+        for row in self.conn.execute(sql + " ORDER BY msg_id DESC", (chat_id, after_id)):
+            yield dict(zip(self.SNAPSHOT_COLUMNS, row))
+
+    def snapshot_ids(self, chat_id):
+        return {r[0] for r in self.conn.execute("SELECT msg_id FROM snapshot WHERE chat_id = ?", (chat_id,))}
 
-async def indexing_engine(client, message, chat_ref, db_file, mode="all"):
-    global GLOBAL_TASK_RUNNING
-    GLOBAL_TASK_RUNNING = True
-    status = await message.reply(f"🚀 **Indexing** `{mode.upper()}`...")
+    def counts(self):
+        rows = dict(self.conn.execute("SELECT db, COUNT(*) FROM items GROUP BY db").fetchall())
+        rows[DB_FILES["history"]] = self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        return rows
+
+INDEX_STORE = IndexStore(DB_FILES["store"])
+
+# --- CHANNEL SNAPSHOT (ONE HISTORY SCAN, MANY LOCAL PASSES) ---
+
+def snapshot_row(msg):
+    """(msg_id, kind, unique_id, file_name, size, caption, mime) for one message."""
+    media = msg.video or msg.document
+    kind = "video" if msg.video else ("document" if msg.document else None)
+    if not media: return (msg.id, None, None, None, 0, msg.caption, None)
+    return (msg.id, kind, getattr(media, 'file_unique_id', None), getattr(media, 'file_name', None),
+            getattr(media, 'file_size', 0), msg.caption, getattr(media, 'mime_type', None))
+
+def snapshot_media_details(row):
+    """get_media_details() for a snapshot row."""
+    if not row["kind"]: return None, 0, None
+    if row["kind"] == "document":
+        mime = row["mime"] or ""
+        if "video" not in mime:
+            fname = (row["file_name"] or "").lower()
+            if not fname.endswith(('.mkv', '.mp4', '.avi', '.webm', '.mov')):
+                return None, 0, None
+    return row["file_name"], row["size"], row["unique_id"]
+
+async def parallel_scan(chat_id, low_id, high_id, sink, status=None):
+    """
+    Fetches message ids (low_id, high_id] with batched get_messages, spread over every
+    connected session through run_work_queue. Ranges are queued newest first; a session
+    hitting FloodWait hands its range back to the others. sink(messages) receives each
+    batch of live messages. Returns (fetched, complete).
+    """
+    step = INDEX_CONFIG["probe_batch"]
+    ranges = [(max(low_id, hi - step), hi) for hi in range(high_id, low_id, -step)]
+    progress = {"fetched": 0}
+
+    async def fetch_ranges(client, batch, session_name):
+        fetched = 0
+        failed = []
+        for lo, hi in batch:
+            await RATE_LIMITER.acquire(client, "read")
+            try: msgs = await client.get_messages(chat_id, list(range(hi, lo, -1)))
+            except FloodWait as e:
+                RATE_LIMITER.flood(client, "read", e.value)
+                raise
+            except Exception as e:
+                print(f"[{session_name}] Scan Error ({lo}-{hi}): {e}")
+                failed.append(((lo, hi), repr(e), True))
+                continue
+            RATE_LIMITER.success(client, "read")
+            live = [msg for msg in msgs if msg and not msg.empty]
+            sink(live)
+            fetched += len(live)
+            progress["fetched"] += len(live)
+        if status: status.update(f"📡 **Parallel Scan...**\nFetched: {progress['fetched']}")
+        return fetched, failed
+
+    fetched, dead = await run_work_queue(ranges, fetch_ranges, job="scan", chats=[chat_id], window=PIPELINE_CONFIG["read"])
+    return fetched, not dead
+
+async def refresh_snapshot(client, chat_id, status=None, full=False, max_age=None):
+    """
+    Brings the local snapshot of a channel up to date. Fresh snapshots are used as-is,
+    stale ones only fetch messages above their top id, and a full rescan (which also
+    drops deleted messages) runs every SNAPSHOT_CONFIG["full_every"] seconds.
+    max_age overrides SNAPSHOT_CONFIG["max_age"] (0 = always fetch what is new).
+    Large id spans are fetched by all sessions at once via parallel_scan.
+    Returns (fetched, complete); complete is False when the job was stopped or ranges
+    stayed unfetched after every retry, i.e. the snapshot may lack messages.
+    """
+    meta = INDEX_STORE.snapshot_meta(chat_id)
+    now = time.time()
+    full = full or meta is None or now - meta["full_at"] > SNAPSHOT_CONFIG["full_every"]
+    max_age = SNAPSHOT_CONFIG["max_age"] if max_age is None else max_age
+    if not full and now - meta["refreshed"] < max_age: return 0, True
+
+    gen = (meta["gen"] + 1) if meta and full else (meta["gen"] if meta else 1)
+    stop_at = 0 if full else meta["top_id"]
+    top_id = 0 if full else meta["top_id"]
+    newest = 0
+    async for msg in client.get_chat_history(chat_id, limit=1): newest = msg.id
+    batch, count, complete = [], 0, True
+
+    if newest - stop_at >= SNAPSHOT_CONFIG["parallel_min"] and len(POOL.healthy()) > 1:
+        def sink(msgs):
+            INDEX_STORE.snapshot_put(chat_id, gen, [snapshot_row(msg) for msg in msgs])
+        count, complete = await parallel_scan(chat_id, stop_at, newest, sink, status)
+        top_id = max(top_id, newest)
+    else:
+        async for msg in client.get_chat_history(chat_id):
+            if not job_running(): break
+            if msg.id <= stop_at: break
+            top_id = max(top_id, msg.id)
+            batch.append(snapshot_row(msg))
+            count += 1
+            if len(batch) >= SNAPSHOT_CONFIG["batch"]:
+                INDEX_STORE.snapshot_put(chat_id, gen, batch)
+                batch = []
+                if status: status.update(f"📡 **Syncing Channel Snapshot...**\nFetched: {count}")
+        INDEX_STORE.snapshot_put(chat_id, gen, batch)
+    # An interrupted scan keeps its rows but does not move the marks
+    complete = complete and job_running()
+    if complete:
+        if full: INDEX_STORE.snapshot_prune(chat_id, gen)
+        INDEX_STORE.set_snapshot_meta(chat_id, {
+            "top_id": top_id, "refreshed": now, "gen": gen,
+            "full_at": now if full else meta["full_at"]
+        })
+    METRICS.inc("bot_scanned_messages_total", count, chat=chat_id)
+    METRICS.set("bot_scan_rate", count / max(time.time() - now, 1e-6), chat=chat_id)
+    return count, complete
+
+def snapshot_refresh_cost(chat_id, newest, max_age=None):
+    """Estimated get_messages-sized calls refresh_snapshot would need now (0 while fresh)."""
+    meta = INDEX_STORE.snapshot_meta(chat_id)
+    now = time.time()
+    full = meta is None or now - meta["full_at"] > SNAPSHOT_CONFIG["full_every"]
+    max_age = SNAPSHOT_CONFIG["max_age"] if max_age is None else max_age
+    if not full and now - meta["refreshed"] < max_age: return 0
+    span = newest - (0 if full else meta["top_id"])
+    return math.ceil(max(span, 0) / INDEX_CONFIG["probe_batch"])
+
+# --- INDEX HIGH-WATER MARKS ---
+
+def load_index_state():
+    """{db_file: {"chat_id", "top_id", "updated", "reconciled"}}"""
+    if not os.path.exists(DB_FILES["index_state"]): return {}
+    try:
+        with open(DB_FILES["index_state"], "r") as f: return json.load(f)
+    except: return {}
+
+def save_index_state(state):
+    tmp = DB_FILES["index_state"] + ".tmp"
+    with open(tmp, "w") as f: json.dump(state, f)
+    os.replace(tmp, DB_FILES["index_state"])
+
+async def find_deleted_ids(chat_id, msg_ids, status=None):
+    """
+    Probes ids with batched get_messages spread over all sessions and returns
+    (deleted_ids, complete). Only ids that came back empty count as deleted, so
+    batches that failed every retry are treated as still existing.
+    """
+    msg_ids = list(msg_ids)
+    step = INDEX_CONFIG["probe_batch"]
+    progress = {"probed": 0}
+    deleted = set()
+
+    async def probe(client, batch, session_name):
+        await RATE_LIMITER.acquire(client, "read")
+        try: msgs = await client.get_messages(chat_id, batch)
+        except FloodWait as e:
+            RATE_LIMITER.flood(client, "read", e.value)
+            raise
+        except Exception as e: return 0, [(i, repr(e), True) for i in batch]
+        RATE_LIMITER.success(client, "read")
+        deleted.update(i for i, msg in zip(batch, msgs) if not msg or msg.empty)
+        progress["probed"] += len(batch)
+        if status: status.update(f"🔎 **Probing...**\n{progress['probed']}/{len(msg_ids)}")
+        return len(batch), []
+
+    _, dead = await run_work_queue(msg_ids, probe, batch_size=step, job="probe", chats=[chat_id], window=PIPELINE_CONFIG["read"])
+    return deleted, not dead
+
+# --- DEAD-LETTER LIST (ITEMS THAT FAILED EVERY RETRY) ---
+
+class DeadLetters:
+    """Append-only JSONL of failed items: {"action", "meta", "item", "reason", "attempts", "ts"}."""
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, action, meta, dead):
+        if not dead: return
+        with open(self.path, "a") as f:
+            for item, reason, attempts in dead:
+                f.write(json.dumps({"action": action, "meta": meta, "item": item,
+                                    "reason": reason, "attempts": attempts, "ts": time.time()}) + "\n")
+
+    def load(self):
+        if not os.path.exists(self.path): return []
+        records = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try: records.append(json.loads(line))
+                except ValueError: continue
+        return records
+
+    def remove(self, taken):
+        """Drops replayed records; called once their group has run, so a crash never loses any."""
+        taken = {json.dumps(r, sort_keys=True) for r in taken}
+        kept = [r for r in self.load() if json.dumps(r, sort_keys=True) not in taken]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for r in kept: f.write(json.dumps(r) + "\n")
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path): os.remove(self.path)
+
+DEAD_LETTERS = DeadLetters(DB_FILES["dead_letters"])
+
+# --- DRY-RUN PLANS (ON DISK, CHECKSUMMED, STREAMED) ---
+
+class PlanWriter:
+    """Streams plan items to disk. Nothing is confirmable until close() writes the sidecar."""
+    def __init__(self, store, plan_id, action, meta):
+        self.store = store
+        self.path = store.body(plan_id)
+        self.info = {"id": plan_id, "action": action, "meta": meta, "created": time.time()}
+        self.f = gzip.open(self.path + ".tmp", "wb")
+        self.sha = hashlib.sha256()
+        self.count = 0
+        self._write(self.info) # Header line, so an exported file explains itself
+
+    def _write(self, obj):
+        line = (json.dumps(obj, separators=(",", ":")) + "\n").encode()
+        self.sha.update(line)
+        self.f.write(line)
+
+    def add(self, item):
+        self._write(item)
+        self.count += 1
+
+    def close(self):
+        """Publishes the plan; an empty plan is dropped instead (nothing to confirm)."""
+        self.info.update(count=self.count, sha256=self.sha.hexdigest(), done=0)
+        if not self.count:
+            self.discard()
+            return self.info
+        self.f.close()
+        os.replace(self.path + ".tmp", self.path)
+        self.store.save_info(self.info)
+        return self.info
+
+    def discard(self):
+        self.f.close()
+        try: os.remove(self.path + ".tmp")
+        except OSError: pass
+
+class PlanStore:
+    """
+    Dry-run plans as files in PLAN_CONFIG["dir"]: a gzip JSONL body (header line, then one
+    item per line) and a JSON sidecar with count, sha256 of the body and `done`, the
+    number of items already executed. Plans survive restarts, can be exported as is and
+    are executed in chunks straight from disk, so memory stays flat for any plan size.
+    """
+    def __init__(self, config):
+        self.config = config
+        os.makedirs(config["dir"], exist_ok=True)
+        self.next_id = max(self.ids(), default=0) + 1
+
+    def body(self, plan_id): return os.path.join(self.config["dir"], f"plan_{plan_id}.jsonl.gz")
+
+    def sidecar(self, plan_id): return os.path.join(self.config["dir"], f"plan_{plan_id}.json")
+
+    def ids(self):
+        names = os.listdir(self.config["dir"]) if os.path.isdir(self.config["dir"]) else []
+        return sorted(int(n[5:-5]) for n in names if n.startswith("plan_") and n.endswith(".json") and n[5:-5].isdigit())
+
+    def create(self, action, meta):
+        plan_id = self.next_id
+        self.next_id += 1
+        return PlanWriter(self, plan_id, action, meta)
+
+    def write(self, action, meta, items):
+        writer = self.create(action, meta)
+        for item in items: writer.add(item)
+        return writer.close()
+
+    def save_info(self, info):
+        path = self.sidecar(info["id"])
+        with open(path + ".tmp", "w") as f: json.dump(info, f)
+        os.replace(path + ".tmp", path)
+
+    def info(self, plan_id):
+        try:
+            with open(self.sidecar(plan_id), "r") as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def latest(self):
+        """Newest plan that still has items left."""
+        for plan_id in reversed(self.ids()):
+            info = self.info(plan_id)
+            if info and info["done"] < info["count"]: return plan_id
+        return None
+
+    def verify(self, info):
+        """Re-reads the body and checks it against the sidecar's sha256 and count."""
+        sha = hashlib.sha256()
+        lines = 0
+        try:
+            with gzip.open(self.body(info["id"]), "rb") as f:
+                for line in f:
+                    sha.update(line)
+                    lines += 1
+        except (OSError, EOFError): return False
+        return sha.hexdigest() == info["sha256"] and lines == info["count"] + 1
+
+    def chunks(self, plan_id, start=0, limit=None):
+        """Yields lists of up to PLAN_CONFIG["chunk"] items, skipping the first `start`."""
+        end = start + limit if limit is not None else None
+        chunk = []
+        with gzip.open(self.body(plan_id), "rb") as f:
+            next(f) # header
+            for n, line in enumerate(f):
+                if n < start: continue
+                if end is not None and n >= end: break
+                chunk.append(json.loads(line))
+                if len(chunk) >= self.config["chunk"]:
+                    yield chunk
+                    chunk = []
+        if chunk: yield chunk
+
+    def delete(self, plan_id):
+        found = False
+        for path in (self.sidecar(plan_id), self.body(plan_id)):
+            if os.path.exists(path):
+                os.remove(path)
+                found = True
+        return found
+
+    def report_text(self):
+        now = time.time()
+        lines = []
+        for plan_id in self.ids():
+            info = self.info(plan_id)
+            if not info: continue
+            age = int((now - info["created"]) / 60)
+            lines.append(f"📝 Plan `#{plan_id}` {info['action']}: {info['done']}/{info['count']} done, "
+                         f"{age} min old ({get_file_size_str(self.body(plan_id))})")
+        return "\n".join(lines)
+
+PLANS = PlanStore(PLAN_CONFIG)
+
+# --- RESUMABLE FORWARD JOB JOURNAL ---
+
+class ForwardJournal:
+    """
+    Append-only JSONL journal for forwarding jobs.
+    Line 1: job definition + planned items. Then batched {"done": [...], "cursors": {...}}
+    lines and a final {"finished": true}. A torn last line (crash) is ignored on load.
+    """
+    def __init__(self, path, flush_every=50):
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = []
+        self.cursors = {}
+
+    def _append(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self, job, items):
+        self.pending, self.cursors = [], {}
+        with open(self.path, "w") as f: f.write(json.dumps({"job": job, "items": items}) + "\n")
+
+    def mark(self, index, session_name):
+        self.pending.append(index)
+        self.cursors[session_name] = index
+        if len(self.pending) >= self.flush_every: self.flush()
+
+    def flush(self):
+        if not self.pending: return
+        HISTORY.flush() # History first: whatever the journal marks done is already in history
+        self._append({"done": self.pending, "cursors": self.cursors})
+        self.pending = []
+
+    def finish(self):
+        self.flush()
+        self._append({"finished": True})
+
+    def load(self):
+        """Returns (job, items, done_set, cursors, finished) or None."""
+        if not os.path.exists(self.path): return None
+        job, items, done, finished = None, [], set(), False
+        with open(self.path, "r") as f:
+            for line in f:
+                try: rec = json.loads(line)
+                except ValueError: break
+                if "job" in rec: job, items = rec["job"], rec["items"]
+                elif "done" in rec:
+                    done.update(rec["done"])
+                    self.cursors.update(rec.get("cursors", {}))
+                elif rec.get("finished"): finished = True
+        if job is None: return None
+        return job, items, done, dict(self.cursors), finished
+
+FORWARD_JOURNAL = ForwardJournal(DB_FILES["job_journal"])
+
+# --- INDEXING & FORWARDING ENGINES ---
+
+async def indexing_engine(client, message, chat_ref, db_file, mode="all", rebuild=False, reconcile=False):
+    """
+    Indexes a channel into db_file. If a high-water mark exists for the same chat,
+    only messages newer than it are fetched and merged. Deleted messages are
+    dropped by a reconciliation pass every INDEX_CONFIG["reconcile_every"] seconds.
+    """
+    status = ProgressReporter(await message.reply(f"🚀 **Indexing** `{mode.upper()}`..."))
     try:
         chat = await resolve_chat_id(client, chat_ref)
-        data_list = []
-        unique_ids_set = set()
-        name_size_set = set()
+        is_target = "target" in db_file
+        state = load_index_state()
+        mark = state.get(db_file, {})
+        incremental = not rebuild and mark.get("chat_id") == chat.id and os.path.exists(db_file)
+        reconcile_due = reconcile or time.time() - mark.get("reconciled", 0) > INDEX_CONFIG["reconcile_every"]
+        high_water = mark.get("top_id", 0) if incremental else 0
+
+        timer = PhaseTimer("index")
+        _, completed = await refresh_snapshot(client, chat.id, status)
+        timer.mark("fetch")
+        snap = INDEX_STORE.snapshot_meta(chat.id) or {}
+        top_id = max(high_water, snap.get("top_id", 0))
+
+        # Records are appended newest first; a full run starts a fresh file.
+        # Syncing first reads a file changed since the last sync, which finds a torn gzip tail
+        if incremental: INDEX_STORE.sync_file(db_file)
+        writer = IndexWriter(db_file, truncate=not incremental)
         count = 0
-        async for m in client.get_chat_history(chat.id):
-            if not GLOBAL_TASK_RUNNING: break
-            if not (m.video or m.document): continue
-            file_name, file_size, unique_id = get_media_details(m)
+        for row in INDEX_STORE.snapshot_rows(chat.id, media_only=True, after_id=high_water):
+            file_name, file_size, unique_id = snapshot_media_details(row)
             if not unique_id: continue
-            if "target" in db_file:
-                unique_ids_set.add(unique_id)
-                if file_name and file_size: name_size_set.add(f"{file_name}-{file_size}")
-            else:
-                data_list.append({"msg_id": m.id, "chat_id": chat.id, "unique_id": unique_id, "name": file_name, "size": file_size})
+            record = {"msg_id": row["msg_id"], "unique_id": unique_id, "name": file_name, "size": file_size}
+            if not is_target: record["chat_id"] = chat.id
+            writer.add(record)
             count += 1
-            if count % 1000 == 0:
-                try: await status.edit(f"⚡ Scanning: {count}")
-                except: pass
-        if "target" in db_file:
-            with open(db_file, "w") as f: json.dump({"unique_ids": list(unique_ids_set), "compound_keys": list(name_size_set)}, f)
+        writer.close()
+        timer.mark("write")
+
+        removed = 0
+        total = None
+        reconciled = False
+        if incremental and reconcile_due and completed:
+            indexed_ids = list(dict.fromkeys(r["msg_id"] for r in iter_index(db_file) if r.get("msg_id")))
+            status.update(f"🔎 Reconciling {len(indexed_ids)} indexed items...")
+            deleted, reconciled = await find_deleted_ids(chat.id, indexed_ids)
+            removed = len(deleted)
+            total = compact_index(db_file, deleted)
+            timer.mark("reconcile")
+
+        INDEX_STORE.sync_file(db_file)
+        timer.mark("store")
+        timer.done()
+        # Only advance the mark when the scan reached it, otherwise a gap would be skipped forever
+        if completed:
+            state[db_file] = {
+                "chat_id": chat.id, "top_id": top_id, "updated": time.time(),
+                "reconciled": time.time() if (not incremental or (reconcile_due and reconciled)) else mark.get("reconciled", 0)
+            }
+            save_index_state(state)
+        if incremental:
+            summary = f" ({total} total)" if total is not None else ""
+            await status.edit(f"✅ Index Refreshed: +{count} new, -{removed} deleted{summary}.")
         else:
-            data_list.reverse()
-            with open(db_file, "w") as f: json.dump(data_list, f, indent=2)
-        await status.edit(f"✅ Index Complete: {count} items.")
+            await status.edit(f"✅ Index Complete: {count} items.")
     except Exception as e: await status.edit(f"❌ Error: {e}")
-    finally: GLOBAL_TASK_RUNNING = False
 
-async def forwarding_engine(message, source_db, target_db, destination_ref, limit=None, mode_copy=True):
-    global GLOBAL_TASK_RUNNING
-    GLOBAL_TASK_RUNNING = True
-    status = await message.reply("⚙️ **Starting 5-Core Forwarder...**")
+async def forwarding_engine(message, source_db, target_db, destination_ref, limit=None, mode_copy=True, batched=False, ordered=False):
+    status = ProgressReporter(await message.reply("⚙️ **Starting 5-Core Forwarder...**"))
+    timer = PhaseTimer("forward")
     if not os.path.exists(source_db): return await status.edit("❌ Source DB missing.")
-    try:
-        with open(source_db, "r") as f: source_data = json.load(f)
-    except: return await status.edit("❌ DB Error")
     load_target_cache(target_db)
     try:
         dest_chat = await resolve_chat_id(app, destination_ref)
         dest_id = dest_chat.id
     except: return await status.edit("❌ Bad Destination")
     
-    final_list = []
-    for item in source_data:
-        if (item.get("unique_id") in target_cache["unique_ids"]) or (f"{item.get('name')}-{item.get('size')}" in target_cache["name_size"]): continue
-        final_list.append(item)
-    if limit and int(limit) > 0: final_list = final_list[:int(limit)]
+    # Set difference (source - target - history) runs as one indexed query, oldest first
+    try:
+        INDEX_STORE.sync_file(source_db)
+        INDEX_STORE.sync_file(target_db)
+        INDEX_STORE.sync_history()
+        final_list = list(INDEX_STORE.pending_items(source_db, target_db, limit if limit and int(limit) > 0 else None))
+    except Exception as e: return await status.edit(f"❌ DB Error: {e}")
     if not final_list: return await status.edit("✅ Nothing to forward.")
 
-    active_sessions = [c for c in ALL_CLIENTS if c.is_connected]
-    chunk_size = math.ceil(len(final_list) / len(active_sessions))
-    chunks = [final_list[i:i + chunk_size] for i in range(0, len(final_list), chunk_size)]
-    progress_stats = {"success": 0}
+    job = {
+        "source_db": source_db, "target_db": target_db, "destination_ref": destination_ref,
+        "dest_id": dest_id, "mode_copy": mode_copy, "batched": batched, "ordered": ordered, "created": time.time()
+    }
+    FORWARD_JOURNAL.start(job, final_list)
+    timer.mark("plan")
+    await run_forward_job(status, job, final_list, set())
+    timer.mark("execute")
+    timer.done()
+
+async def forward_batch(client, dest_id, from_chat_id, msg_ids, drop_author):
+    """
+    Forwards up to 100 messages in one call. drop_author=True sends them as copies
+    (same result as copy_message without a new caption). Returns the msg_ids Telegram
+    actually sent: every id gets its own random_id and the UpdateMessageID updates
+    echo back the random_ids that went through, so skipped ids are never guessed.
+    """
+    random_ids = [client.rnd_id() for _ in msg_ids]
+    r = await client.invoke(raw.functions.messages.ForwardMessages(
+        to_peer=await client.resolve_peer(dest_id),
+        from_peer=await client.resolve_peer(from_chat_id),
+        id=msg_ids, random_id=random_ids, drop_author=drop_author or None
+    ))
+    sent = {u.random_id for u in getattr(r, "updates", []) if isinstance(u, raw.types.UpdateMessageID)}
+    return [mid for mid, rid in zip(msg_ids, random_ids) if rid in sent]
+
+async def run_forward_job(status, job, items, done):
+    """Forwards every planned item whose index is not in `done`, journaling progress."""
+    dest_id, mode_copy = job["dest_id"], job["mode_copy"]
+    batched = job.get("batched", False)
+    progress_stats = {"success": len(done)}
+
+    def mark_sent(index, session_name):
+        item = items[index]
+        save_history(item.get("unique_id"), item.get("name"), item.get("size"))
+        FORWARD_JOURNAL.mark(index, session_name)
+        progress_stats["success"] += 1
+
+    def report():
+        status.update(f"🚀 Sent: {progress_stats['success']}/{len(items)}")
 
     async def session_worker(client, worker_data, session_name):
-        local_batch = 0
-        for item in worker_data:
-            if not GLOBAL_TASK_RUNNING: break
+        sent = 0
+        failed = []
+        for n, index in enumerate(worker_data):
+            if not job_running(): break
+            item = items[index]
             try:
+                await RATE_LIMITER.acquire(client, "copy")
                 if mode_copy: await client.copy_message(dest_id, item['chat_id'], item['msg_id'])
                 else: await client.forward_messages(dest_id, item['chat_id'], item['msg_id'])
-                save_history(item.get("unique_id"), item.get("name"), item.get("size"))
-                progress_stats["success"] += 1
-                local_batch += 1
-                if progress_stats["success"] % 50 == 0: 
-                    try: await status.edit(f"🚀 Sent: {progress_stats['success']}")
-                    except: pass
-                if local_batch >= BATCH_SIZE:
-                    await asyncio.sleep(BREAK_TIME)
-                    local_batch = 0
-                else: await asyncio.sleep(PER_MSG_DELAY)
+                RATE_LIMITER.success(client, "copy")
+                mark_sent(index, session_name)
+                sent += 1
+                report()
             except FloodWait as e:
-                await asyncio.sleep(e.value + 5)
-            except Exception: pass
-            
-    tasks = []
-    for i, session in enumerate(active_sessions):
-        if i < len(chunks):
-            tasks.append(session_worker(session, chunks[i], f"Session-{i+1}"))
-    await asyncio.gather(*tasks)
-    GLOBAL_TASK_RUNNING = False
-    await status.edit(f"✅ Forwarding Complete: {progress_stats['success']}")
+                RATE_LIMITER.flood(client, "copy", e.value)
+                if n == 0: raise
+                failed.extend((i, f"FloodWait {e.value}s", True) for i in worker_data[n:])
+                break
+            except Exception as e:
+                failed.append((index, repr(e), not isinstance(e, PERMANENT_ERRORS)))
+        return sent, failed
 
-# --- OLD COMMANDS (UNCHANGED) ---
+    async def batch_worker(client, worker_data, session_name):
+        """Sends runs of consecutive items from the same source chat as one multi-id call."""
+        sent = 0
+        failed = []
+        groups = []
+        for index in worker_data:
+            if groups and groups[-1][0] == items[index]['chat_id']: groups[-1][1].append(index)
+            else: groups.append((items[index]['chat_id'], [index]))
+        for n, (from_chat_id, indices) in enumerate(groups):
+            if not job_running(): break
+            try:
+                await RATE_LIMITER.acquire(client, "copy")
+                ok_ids = set(await forward_batch(client, dest_id, from_chat_id, [items[i]['msg_id'] for i in indices], mode_copy))
+                RATE_LIMITER.success(client, "copy")
+            except FloodWait as e:
+                RATE_LIMITER.flood(client, "copy", e.value)
+                if n == 0: raise
+                failed.extend((i, f"FloodWait {e.value}s", True) for _, rest in groups[n:] for i in rest)
+                break
+            except Exception as e:
+                # One bad id fails the whole call: fall back to one call per item to isolate it
+                if len(indices) == 1: failed.append((indices[0], repr(e), not isinstance(e, PERMANENT_ERRORS)))
+                else:
+                    try: s_ok, s_failed = await session_worker(client, indices, session_name)
+                    except FloodWait as fw: # Earlier groups are already sent, so never hand the batch back
+                        failed.extend((i, f"FloodWait {fw.value}s", True) for _, rest in groups[n:] for i in rest)
+                        break
+                    sent += s_ok
+                    failed.extend(s_failed)
+                continue
+            for i in indices:
+                if items[i]['msg_id'] in ok_ids:
+                    mark_sent(i, session_name)
+                    sent += 1
+                else: failed.append((i, "Skipped by Telegram (deleted in source?)", False))
+            report()
+        return sent, failed
+
+    # Items sent after the last journal flush are already in history -> skip them too
+    pending = [i for i in range(len(items)) if i not in done and items[i].get("unique_id") not in target_cache["unique_ids"]]
+    chats = [dest_id] + sorted({items[i]['chat_id'] for i in pending})
+    window = 1 if job.get("ordered") else PIPELINE_CONFIG["copy"]
+    stopped = False
+    dead = []
+    try:
+        if batched: _, dead = await run_work_queue(pending, batch_worker, batch_size=FORWARD_CONFIG["batch_size"], job="forward", chats=chats, window=window)
+        else: _, dead = await run_work_queue(pending, session_worker, job="forward", chats=chats, window=window)
+        DEAD_LETTERS.add("forward", {"dest_id": dest_id, "mode_copy": mode_copy, "target_db": job["target_db"]},
+                         [(items[i], reason, attempts) for i, reason, attempts in dead])
+        stopped = not job_running()
+    except ChatUnreachable as e:
+        return await status.edit(f"⏸️ Forwarding Paused: {e}.\nUse `/resume` once a session can reach it.")
+    finally:
+        FORWARD_JOURNAL.flush()
+        HISTORY.flush()
+        HISTORY.maybe_compact()
+        RATE_LIMITER.save()
+    if stopped:
+        return await status.edit(f"⏸️ Forwarding Stopped: {progress_stats['success']}/{len(items)}\nUse `/resume` to continue.")
+    FORWARD_JOURNAL.finish()
+    failed_note = f"\n☠️ Dead-lettered: {len(dead)} (`/dead_letters`)" if dead else ""
+    await status.edit(f"✅ Forwarding Complete: {progress_stats['success']}{failed_note}")
+
+# --- CORE COMMANDS (INDEX, FORWARD, JOBS, STATS) ---
 
 @app.on_message(filters.command("start") & filters.create(only_admin))
 async def start_msg(_, m):
     txt = (
         "🤖 **Ultra Advanced Bot V4.5 (Cleaner Edition)**\n\n"
         "**🧹 Library Cleaner**\n"
-        "`/scan_library_dupes @channel` - Find duplicates.\n"
+        "`/scan_library_dupes @channel [fuzzy]` - Find duplicates.\n"
         "`/edit_metadata @channel` - Clean captions.\n"
-        "`/sync_library_with_db @channel` - Sync MongoDB.\n"
-        "`/confirm_clean` - Execute changes.\n"
-        "`/cancel_clean` - Cancel changes.\n\n"
+        "`/sync_library_with_db @channel [probe|scan]` - Sync MongoDB.\n"
+        "`/confirm_clean [plan] [limit]` - Execute changes (resumable).\n"
+        "`/cancel_clean [plan]` - Cancel changes.\n"
+        "`/export_plan [plan]` - Send the plan file.\n\n"
         "**📂 Indexing & Forwarding**\n"
-        "`/index @ch` | `/forward_movie @target`\n"
-        "`/stats` | `/stop` | `/sync`"
+        "`/index @ch [rebuild|reconcile]` | `/forward_movie @target [limit] [batch] [ordered]`\n"
+        "`/snapshot @ch [full]` | `/stats` | `/resume` | `/sync`\n"
+        "`/jobs` | `/stop [id]` | `/prio <id> high|normal|low`\n"
+        "`/dead_letters` | `/replay_dead [action]`\n"
+        "`/profile start [cpu|sample|mem|all]` | `/profile stop` | `/profile status`"
     )
     await m.reply(txt)
 
 @app.on_message(filters.command("stats") & filters.create(only_admin))
 async def stats_cmd(_, m):
     # Existing stats code condensed for brevity
-    report = f"📊 **Stats**\nCores: {len([c for c in ALL_CLIENTS if c.is_connected])}/5"
+    report = f"📊 **Stats**\nCores: {len(POOL.healthy())}/{len(ALL_CLIENTS)} healthy\n{POOL.report_text()}"
+    try:
+        for name, path in DB_FILES.items():
+            if name in ("movie_source", "movie_target", "full_source", "full_target"): INDEX_STORE.sync_file(path)
+        INDEX_STORE.sync_history()
+        counts = INDEX_STORE.counts()
+        for name, path in DB_FILES.items():
+            if path in counts: report += f"\n`{name}`: {counts[path]} rows ({get_file_size_str(path)})"
+    except Exception as e: report += f"\nStore Error: {e}"
+    report += telemetry_report()
     await m.reply(report)
 
 @app.on_message(filters.command("del_db") & filters.create(only_admin))
 async def delete_db_cmd(_, m):
     if len(m.command) < 2: return await m.reply("Usage: `/del_db <name>`")
+    if m.command[1] == "store": return await m.reply("❌ The store is rebuilt from the index files; delete those instead.")
     path = DB_FILES.get(m.command[1])
     if path and os.path.exists(path):
         os.remove(path)
+        INDEX_STORE.drop(path)
         await m.reply("Deleted.")
     else: await m.reply("Not found.")
 
@@ -733,44 +2982,196 @@ async def sync_cmd(_, m):
 
 @app.on_message(filters.command("stop") & filters.create(only_admin))
 async def stop_cmd(_, m):
-    global GLOBAL_TASK_RUNNING
-    GLOBAL_TASK_RUNNING = False
-    await m.reply("🛑 Stopped.")
+    """`/stop <id>` stops one job; `/stop` alone stops every job."""
+    if len(m.command) > 1:
+        job_id = int(m.command[1]) if m.command[1].isdigit() else None
+        if not JOBS.cancel(job_id): return await m.reply("❌ No such running job. See `/jobs`.")
+        return await m.reply(f"🛑 Stopping job `#{job_id}`.")
+    stopped = [j.id for j in JOBS.active() if JOBS.cancel(j.id)]
+    await m.reply(f"🛑 Stopped: {', '.join(f'`#{i}`' for i in stopped)}." if stopped else "🛑 Nothing running.")
+
+@app.on_message(filters.command("jobs") & filters.create(only_admin))
+async def jobs_cmd(_, m):
+    plans = PLANS.report_text()
+    await m.reply("⏱️ **Jobs**\n" + JOBS.report_text() + (f"\n\n{plans}" if plans else "") +
+                  "\n\n`/stop <id>` | `/prio <id> high|normal|low` | `/confirm_clean <plan> [limit]` | `/export_plan <plan>`")
+
+@app.on_message(filters.command("prio") & filters.create(only_admin))
+async def prio_cmd(_, m):
+    """`/prio <id> high|normal|low`: queue order and share of the session pipelines."""
+    job = JOBS.jobs.get(int(m.command[1])) if len(m.command) > 2 and m.command[1].isdigit() else None
+    level = m.command[2].lower() if len(m.command) > 2 else None
+    if not job or level not in JOB_CONFIG["weights"]: return await m.reply("Usage: `/prio <id> high|normal|low`")
+    job.priority = level
+    JOBS._pump()
+    await m.reply(f"✅ Job `#{job.id}` priority: `{level}`")
+
+@app.on_message(filters.command("snapshot") & filters.create(only_admin))
+@job_command("snapshot", chat_keys)
+async def snapshot_cmd(c, m):
+    if len(m.command) < 2: return await m.reply("Usage: `/snapshot @channel [full]`")
+    full = len(m.command) > 2 and m.command[2].lower() == "full"
+    status = ProgressReporter(await m.reply("📡 **Refreshing Channel Snapshot...**"))
+    try:
+        chat = await resolve_chat_id(c, m.command[1])
+        fetched, complete = await refresh_snapshot(c, chat.id, status, full=full)
+        note = "" if complete else "\n⚠️ Incomplete (failed ranges or stopped): marks not moved, run again."
+        await status.edit(f"✅ Snapshot Ready: `{len(INDEX_STORE.snapshot_ids(chat.id))}` messages (fetched `{fetched}`).{note}")
+    except Exception as e: await status.edit(f"❌ Error: {e}")
+
+@app.on_message(filters.command("profile") & filters.create(only_admin))
+async def profile_cmd(_, m):
+    """`/profile start [cpu|sample|mem|all]` | `/profile stop` | `/profile status`"""
+    sub = m.command[1].lower() if len(m.command) > 1 else "status"
+    if sub == "start":
+        modes = [a.lower() for a in m.command[2:]] or ["all"]
+        if "all" in modes: modes = ["cpu", "sample", "mem"]
+        if not set(modes) <= {"cpu", "sample", "mem"}: return await m.reply("Usage: `/profile start [cpu|sample|mem|all]`")
+        try: PROFILER.start(modes)
+        except Exception as e: return await m.reply(f"⚠️ {e}")
+        return await m.reply(f"🔬 **Profiling ON:** `{', '.join(modes)}`\nRunning jobs: `{', '.join(f'#{j.id}' for j in JOBS.active()) or 'none'}`\nUse `/profile stop` for the report.")
+    if sub == "stop":
+        path = f"profile_{int(time.time())}.txt"
+        try: PROFILER.stop(path) # On the loop thread: cProfile can only be disabled where it was enabled
+        except Exception as e: return await m.reply(f"⚠️ {e}")
+        await m.reply_document(path, caption="🔬 Profile report")
+        if os.path.exists(path + ".prof"): await m.reply_document(path + ".prof", caption="📦 cProfile dump (pstats / snakeviz)")
+        for p in (path, path + ".prof"):
+            if os.path.exists(p): os.remove(p)
+        return
+    running = ", ".join(sorted(PROFILER.modes)) or "off"
+    await m.reply(f"🔬 **Profiler:** `{running}`\n\n```\n{PROFILER.phase_report()}```")
+
+@app.on_message(filters.command("dead_letters") & filters.create(only_admin))
+async def dead_letters_cmd(_, m):
+    if len(m.command) > 1 and m.command[1].lower() == "clear":
+        DEAD_LETTERS.clear()
+        return await m.reply("✅ Dead-letter list cleared.")
+    records = DEAD_LETTERS.load()
+    if not records: return await m.reply("✅ No dead-lettered items.")
+    by_action = {}
+    for r in records: by_action[r["action"]] = by_action.get(r["action"], 0) + 1
+    txt = "☠️ **Dead Letters**\n" + "\n".join(f"`{a}`: {n}" for a, n in by_action.items())
+    txt += "\n\n**Latest:**\n" + "\n".join(f"• `{r['action']}` x{r['attempts']}: {r['reason'][:80]}" for r in records[-5:])
+    txt += "\n\n`/replay_dead [action]` | `/dead_letters clear`"
+    await m.reply(txt)
+
+@app.on_message(filters.command("replay_dead") & filters.create(only_admin))
+@job_command("replay", lambda m: [("dead_letters",), ("forward",)])
+async def replay_dead_cmd(_, m):
+    action = m.command[1] if len(m.command) > 1 else None
+    records = [r for r in DEAD_LETTERS.load() if action in (None, r["action"])]
+    if not records: return await m.reply("✅ Nothing to replay.")
+    state = FORWARD_JOURNAL.load()
+    if any(r["action"] == "forward" for r in records) and state and not state[4]:
+        return await m.reply("❌ The last forward job is unfinished and a replay would overwrite its journal.\n"
+                             "Use `/resume` first, or `/replay_dead <action>` for the other actions.")
+    status = ProgressReporter(await m.reply(f"♻️ **Replaying {len(records)} dead-lettered items...**"))
+    groups = {}
+    for r in records: groups.setdefault((r["action"], json.dumps(r["meta"], sort_keys=True)), []).append(r)
+    summary = []
+    for (act, meta_json), group in groups.items():
+        meta = json.loads(meta_json)
+        if not job_running(): break # Stopped: groups not replayed yet stay on the list untouched
+        items = [r["item"] for r in group]
+        if act == "forward":
+            job = {"source_db": None, "target_db": meta["target_db"], "destination_ref": meta["dest_id"],
+                   "dest_id": meta["dest_id"], "mode_copy": meta["mode_copy"], "created": time.time()}
+            load_target_cache(job["target_db"])
+            FORWARD_JOURNAL.start(job, items)
+            DEAD_LETTERS.remove(group) # The journal owns them now: `/resume` finishes a stopped replay
+            await run_forward_job(status, job, items, set())
+            summary.append(f"`forward`: {len(items)} replayed")
+            continue
+        try: done, dead = await execute_channel_action(act, items, meta["chat_id"])
+        except ChatUnreachable as e: # Not tried: the group stays on the list
+            summary.append(f"`{act}`: {e}")
+            continue
+        if not job_running(): break # Interrupted: the group keeps its records and can be replayed again
+        DEAD_LETTERS.remove(group)
+        DEAD_LETTERS.add(act, meta, dead)
+        summary.append(f"`{act}`: {done} ok, {len(dead)} still failing")
+    title = "♻️ **Replay Finished**" if job_running() else "⏸️ **Replay Stopped** (the rest stays dead-lettered)"
+    await m.reply(title + "\n" + "\n".join(summary))
+
+@app.on_message(filters.command("resume") & filters.create(only_admin))
+@job_command("resume", lambda m: [("forward",)])
+async def resume_cmd(_, m):
+    state = FORWARD_JOURNAL.load()
+    if not state: return await m.reply("❌ No forward job to resume.")
+    job, items, done, cursors, finished = state
+    if finished: return await m.reply("✅ Last forward job already completed.")
+    status = ProgressReporter(await m.reply(
+        f"♻️ **Resuming Forward Job...**\n"
+        f"Done: `{len(done)}/{len(items)}`\n"
+        f"Cursors: `{cursors}`"
+    ))
+    load_target_cache(job["target_db"])
+    await run_forward_job(status, job, items, done)
+
+async def index_keys(m):
+    """Index jobs also own their index file (one per command)."""
+    db = {"index": "movie_source", "index_target": "movie_target", "index_full": "full_source", "index_target_full": "full_target"}
+    return await chat_keys(m) + [("file", DB_FILES[db[m.command[0]]])]
+
+def index_opts(m):
+    """Optional flags after the chat: `rebuild` (ignore high-water mark), `reconcile` (check deletions now)."""
+    flags = [a.lower() for a in m.command[2:]]
+    return {"rebuild": "rebuild" in flags, "reconcile": "reconcile" in flags}
 
 @app.on_message(filters.command("index") & filters.create(only_admin))
+@job_command("index", index_keys)
 async def cmd_idx_mov(c, m):
     if len(m.command) < 2: return
-    await indexing_engine(c, m, m.command[1], DB_FILES["movie_source"], mode="movie")
+    await indexing_engine(c, m, m.command[1], DB_FILES["movie_source"], mode="movie", **index_opts(m))
 
 @app.on_message(filters.command("index_target") & filters.create(only_admin))
+@job_command("index", index_keys)
 async def cmd_idx_tgt_mov(c, m):
     if len(m.command) < 2: return
-    await indexing_engine(c, m, m.command[1], DB_FILES["movie_target"], mode="target")
+    await indexing_engine(c, m, m.command[1], DB_FILES["movie_target"], mode="target", **index_opts(m))
 
 @app.on_message(filters.command("index_full") & filters.create(only_admin))
+@job_command("index", index_keys)
 async def cmd_idx_full(c, m):
     if len(m.command) < 2: return
-    await indexing_engine(c, m, m.command[1], DB_FILES["full_source"], mode="all")
+    await indexing_engine(c, m, m.command[1], DB_FILES["full_source"], mode="all", **index_opts(m))
 
 @app.on_message(filters.command("index_target_full") & filters.create(only_admin))
+@job_command("index", index_keys)
 async def cmd_idx_tgt_full(c, m):
     if len(m.command) < 2: return
-    await indexing_engine(c, m, m.command[1], DB_FILES["full_target"], mode="target")
+    await indexing_engine(c, m, m.command[1], DB_FILES["full_target"], mode="target", **index_opts(m))
+
+def forward_opts(m):
+    """
+    `/forward_* @dest [limit] [batch] [ordered]` -> limit, batched mode (up to 100 ids
+    per call) and ordered mode (one request in flight per session instead of PIPELINE_CONFIG["copy"]).
+    """
+    args = m.command[2:]
+    flags = [a.lower() for a in args]
+    limit = next((a for a in args if a.isdigit()), None)
+    return limit, "batch" in flags, "ordered" in flags
 
 @app.on_message(filters.command("forward_movie") & filters.create(only_admin))
+@job_command("forward", lambda m: [("forward",)])
 async def cmd_fwd_mov(c, m):
     if len(m.command) < 2: return
-    limit = m.command[2] if len(m.command) > 2 else None
-    await forwarding_engine(m, DB_FILES["movie_source"], DB_FILES["movie_target"], m.command[1], limit)
+    limit, batched, ordered = forward_opts(m)
+    await forwarding_engine(m, DB_FILES["movie_source"], DB_FILES["movie_target"], m.command[1], limit, batched=batched, ordered=ordered)
 
 @app.on_message(filters.command("forward_full") & filters.create(only_admin))
+@job_command("forward", lambda m: [("forward",)])
 async def cmd_fwd_full(c, m):
     if len(m.command) < 2: return
-    limit = m.command[2] if len(m.command) > 2 else None
-    await forwarding_engine(m, DB_FILES["full_source"], DB_FILES["full_target"], m.command[1], limit)
+    limit, batched, ordered = forward_opts(m)
+    await forwarding_engine(m, DB_FILES["full_source"], DB_FILES["full_target"], m.command[1], limit, batched=batched, ordered=ordered)
 
 if __name__ == "__main__":
     print("🤖 Ultra Bot V4.5 (5-Core Cleaner) Initializing...")
     start_web_server()
+    migrate_legacy_indexes()
+    HISTORY.maybe_compact()
     print(f"🚀 Launching {len(ALL_CLIENTS)} Independent Sessions...")
-    compose(ALL_CLIENTS)
+    try: app.run(POOL.run())
+    finally: HISTORY.flush()